@@ -6,15 +6,13 @@ from pathlib import Path
 
 ROOT = Path(__file__).resolve().parent
 
-# Удаляем файл .coverage
-for p in ROOT.glob(".coverage"):
-    try:
-        p.unlink()
-    except FileNotFoundError:
-        pass
-
-# Удаляем htmlcov
-htmlcov = ROOT / "htmlcov"
-if htmlcov.is_dir():
-    shutil.rmtree(htmlcov)
-
+# Один проход по каталогу: удаляем файл .coverage и каталог htmlcov
+with os.scandir(ROOT) as it:
+    for entry in it:
+        if entry.name == ".coverage" and entry.is_file(follow_symlinks=False):
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+        elif entry.name == "htmlcov" and entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
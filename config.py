@@ -11,17 +11,42 @@ import os
 import logging
 from dotenv import load_dotenv
 
+_ENV = os.environ
+
 # 1) Подтягиваем переменные окружения из .env
-# (файл .env лежит рядом с проектом; токен и путь до БД — здесь)
+# (файл .env лежит рядом с проектом; токен и путь до БД — здесь).
+# Разбираем всегда: уже экспортированные переменные (systemd/docker/CI) load_dotenv
+# не перезаписывает, а недостающие (DB_PATH, LOG_LEVEL, ключ OpenRouter...) берёт из .env.
 load_dotenv()
 
 # 2) Читаем переменные; DB_PATH имеет дефолт "bot.db"
-TOKEN: str | None = os.getenv("TOKEN")
-DB_PATH: str = os.getenv("DB_PATH", "bot.db")
-DEFAULT_NOTIFY_HOUR = int(os.getenv("DEFAULT_NOTIFY_HOUR", "9"))
+TOKEN: str | None = _ENV.get("TOKEN")
+DB_PATH: str = _ENV.get("DB_PATH", "bot.db")
+DEFAULT_NOTIFY_HOUR = int(_ENV.get("DEFAULT_NOTIFY_HOUR", "9"))
+
+# Режим fsync для SQLite: NORMAL (по умолчанию, быстро в WAL) или FULL (строгая надёжность)
+DB_SYNCHRONOUS = _ENV.get("DB_SYNCHRONOUS", "NORMAL").upper()
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    DB_SYNCHRONOUS = "NORMAL"
+
+# Сколько апдейтов TeleBot обрабатывает параллельно (пул потоков обработчиков).
+# /ask ждёт ответа LLM секундами — при 2 потоках (дефолт TeleBot) два таких запроса
+# блокируют команды всех остальных пользователей.
+BOT_NUM_THREADS = max(1, int(_ENV.get("BOT_NUM_THREADS", "8")))
+
+# Отдельный пул для запросов к LLM: /ask не занимает поток TeleBot на время ответа
+# модели, поэтому число одновременных вопросов не ограничено BOT_NUM_THREADS.
+LLM_NUM_THREADS = max(1, int(_ENV.get("LLM_NUM_THREADS", "16")))
+# Сколько вопросов к LLM может ждать в очередях одновременно; сверх этого бот сразу
+# отвечает «перегружен», а не копит очередь (и потоки с памятью под неё) без предела.
+LLM_MAX_PENDING = max(1, int(_ENV.get("LLM_MAX_PENDING", "200")))
+
+# OpenRouter: ключ API и сколько запросов в секунду отправлять (подберите под тариф аккаунта)
+OPENROUTER_API_KEY: str | None = _ENV.get("OPENROUTER_API_KEY")
+OPENROUTER_MAX_RPS = float(_ENV.get("OPENROUTER_MAX_RPS", "10"))
 
 # 3) Уровень логирования настраиваем через .env (или оставляем INFO)
-LOG_LEVEL_NAME = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVEL_NAME = _ENV.get("LOG_LEVEL", "INFO").upper()
 LOG_LEVEL = getattr(logging, LOG_LEVEL_NAME, logging.INFO)
 
 # 4) Базовая конфигурация логов для всего приложения
@@ -41,6 +66,9 @@ __all__ = ["TOKEN", "DB_PATH", "LOG_LEVEL"]
 # Максимальная длина текста вопроса пользователя (в символах)
 MAX_PROMPT_CHARS_DEFAULT = 600
 
+# Та же длина в байтах UTF-8: бюджет запроса к OpenRouter не зависит от языка вопроса
+MAX_PROMPT_BYTES_DEFAULT = 2000
+
 # Показывать ли в ответе модели доп.инфо
 SHOW_MODEL_FOOTER_DEFAULT = True
 
@@ -52,3 +80,6 @@ DEBUG_SETTINGS_SHOW = False
 # Использование команды смены модели
 CMD_MODEL_ID_ENABLED = True
 
+# Склейка одновременных /ask к одной модели и персонажу в один запрос к OpenRouter
+ASK_BATCHING_ENABLED = False
+
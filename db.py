@@ -2,9 +2,18 @@
 db.py — слой доступа к данным (SQLite через sqlite3, без ORM).
 
 Особенности:
-- Контекстный менеджер на каждую операцию (with _connect()) — гарантирует commit/rollback.
-- PRAGMA:
+- Пул долгоживущих подключений (with _connect()) — гарантирует commit/rollback,
+  а PRAGMA выполняются один раз на подключение, а не на каждую операцию.
+- Чтение и запись разделены: _connect() — писатели, по очереди внутри процесса;
+  _read() — отдельный пул подключений с query_only, читатели не ждут ни друг друга, ни записи.
+- Подготовленные запросы кэшируются на подключении (cached_statements, ключ — текст SQL).
+  Кэш работает именно благодаря пулу: раньше он умирал вместе с подключением после
+  каждой операции. Поэтому SQL — всегда обычные литералы с "?", без f-строк.
+- Autocommit (isolation_level=None): одиночный запрос атомарен сам по себе,
+  многошаговые записи явно открывают BEGIN IMMEDIATE.
+- PRAGMA (см. _PRAGMAS):
     * WAL (журналирование вперёд) — меньше "database is locked";
+    * synchronous=NORMAL — меньше fsync при записи;
     * busy_timeout — вежливое ожидание при блокировке.
 - row_factory = sqlite3.Row — доступ к полям по именам, удобно для форматирования.
 
@@ -13,13 +22,19 @@ db.py — слой доступа к данным (SQLite через sqlite3, б
 """
 
 from __future__ import annotations
-from datetime import datetime
-from typing import Optional
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
 
+import atexit
+import os
+import queue
 import sqlite3
+import random
 import logging
+import threading
+import time
 
-from config import DB_PATH, DEFAULT_NOTIFY_HOUR
+from config import DB_PATH, DB_SYNCHRONOUS, DEFAULT_NOTIFY_HOUR
 
 log = logging.getLogger(__name__)
 
@@ -27,43 +42,305 @@ log = logging.getLogger(__name__)
 # Низкоуровневое подключение
 # ---------------------------
 
-def _connect() -> sqlite3.Connection:
+# Размер пула: примерно по числу потоков-обработчиков TeleBot
+POOL_SIZE = max(2, os.cpu_count() or 2)
+
+# Сколько подготовленных запросов держать на одно подключение (по умолчанию 128)
+STATEMENT_CACHE_SIZE = 256
+
+# UPDATE/INSERT ... RETURNING поддерживается с SQLite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Два пула: подключения для записи (_connect) и только для чтения (_read).
+# LIFO — чтобы чаще брать «тёплое» подключение с прогретым кэшем страниц
+_POOL: "queue.LifoQueue[tuple[str, sqlite3.Connection]]" = queue.LifoQueue(maxsize=POOL_SIZE)
+_READ_POOL: "queue.LifoQueue[tuple[str, sqlite3.Connection]]" = queue.LifoQueue(maxsize=POOL_SIZE)
+
+# В WAL писатель у SQLite всё равно один. Очередь писателей держим в процессе:
+# lock передаётся сразу, а не через busy_timeout, который «спит» и опрашивает файл заново.
+# Читатели (_read) этот lock не берут и друг друга не ждут.
+_WRITE_LOCK = threading.RLock()
+
+
+# PRAGMA для каждого нового подключения:
+# - journal_mode=WAL: снижает вероятность 'database is locked';
+# - synchronous=NORMAL: в режиме WAL безопасно для целостности БД, fsync только
+#   на checkpoint. Цена — при сбое питания/ОС могут потеряться последние
+#   подтверждённые транзакции (но не сама БД); для учебного бота это приемлемо.
+#   Для строгой надёжности: DB_SYNCHRONOUS=FULL в .env;
+# - busy_timeout=5000: ожидание 5 сек при занятой БД;
+# - foreign_keys=ON: соблюдение внешних ключей (на будущее);
+# - temp_store=MEMORY, cache_size=-64000: временные структуры и ~64 МБ кэша в памяти;
+# - mmap_size=256 МБ: горячие страницы читаются через mmap, без read();
+# - wal_autocheckpoint=1000: checkpoint каждые ~1000 страниц WAL (значение SQLite по умолчанию, явно).
+_PRAGMAS = f"""
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = {DB_SYNCHRONOUS};
+PRAGMA busy_timeout = 5000;
+PRAGMA foreign_keys = ON;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -64000;
+PRAGMA mmap_size = 268435456;
+PRAGMA wal_autocheckpoint = 1000;
+"""
+
+
+def _new_conn(path: str, readonly: bool = False) -> sqlite3.Connection:
     """
     Открывает подключение к SQLite с разумными настройками для учебного бота.
     - timeout=5.0: подождать до 5 сек при блокировках;
-    - PRAGMA foreign_keys=ON: соблюдение внешних ключей (на будущее);
-    - PRAGMA journal_mode=WAL: снижает вероятность 'database is locked';
-    - PRAGMA busy_timeout=5000: ожидание 5 сек при занятой БД;
-    - row_factory=sqlite3.Row: строки как словари.
+    - check_same_thread=False: подключение живёт в пуле и переходит между потоками
+      (одновременно им пользуется только один поток);
+    - isolation_level=None: autocommit — одиночный запрос атомарен сам по себе и не требует
+      неявного BEGIN/COMMIT; многошаговые записи явно открывают BEGIN IMMEDIATE;
+    - cached_statements: кэш скомпилированных запросов на подключение. Ключ — текст SQL,
+      поэтому одинаковые литералы в функциях ниже компилируются один раз за жизнь подключения;
+    - row_factory=sqlite3.Row: строки как словари;
+    - PRAGMA (_PRAGMAS) — одним executescript, один раз на подключение;
+    - readonly=True: PRAGMA query_only — случайная запись через пул читателей упадёт сразу.
     """
-    conn = sqlite3.connect(DB_PATH, timeout=5.0)
+    conn = sqlite3.connect(
+        path,
+        timeout=5.0,
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.execute("PRAGMA journal_mode = WAL")
-    conn.execute("PRAGMA busy_timeout = 5000")
+    conn.executescript(_PRAGMAS)
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
     return conn
 # Подробнее про WAL/busy_timeout и row_factory — в Л3.
 
 
+def _get_conn(pool: queue.LifoQueue = _POOL) -> tuple[str, sqlite3.Connection]:
+    """
+    Взять подключение из пула (или открыть новое, если пул пуст).
+    Подключения к «старому» DB_PATH (например, после смены пути в тестах) закрываем.
+    """
+    while True:
+        try:
+            path, conn = pool.get_nowait()
+        except queue.Empty:
+            return DB_PATH, _new_conn(DB_PATH, readonly=pool is _READ_POOL)
+        if path == DB_PATH:
+            return path, conn
+        conn.close()
+
+
+def _put_conn(path: str, conn: sqlite3.Connection, pool: queue.LifoQueue = _POOL) -> None:
+    """
+    Вернуть подключение в пул; если пул заполнен — просто закрыть его.
+    """
+    try:
+        pool.put_nowait((path, conn))
+    except queue.Full:
+        conn.close()
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """
+    Одолжить подключение из пула на время одной операции:
+    commit при успехе, rollback при исключении.
+    При sqlite3.OperationalError подключение закрываем, а не возвращаем в пул.
+    Для записи: писатели процесса идут по очереди (_WRITE_LOCK). Только чтение — _read().
+    """
+    with _WRITE_LOCK:
+        path, conn = _get_conn()
+        try:
+            yield conn
+            conn.commit()
+        except sqlite3.OperationalError:
+            conn.rollback()
+            conn.close()
+            raise
+        except BaseException:
+            conn.rollback()
+            _put_conn(path, conn)
+            raise
+        else:
+            _put_conn(path, conn)
+
+
+@contextmanager
+def _read(tuples: bool = False) -> Iterator[sqlite3.Connection]:
+    """
+    Одолжить подключение только для чтения из отдельного пула (PRAGMA query_only).
+    Не ждёт писателей: в WAL чтение идёт по снимку БД параллельно с записью.
+    tuples=True — строки как обычные кортежи (см. _connect_tuple).
+    """
+    path, conn = _get_conn(_READ_POOL)
+    if tuples:
+        conn.row_factory = None
+    try:
+        yield conn
+    except sqlite3.OperationalError:
+        conn.close()
+        raise
+    except BaseException:
+        conn.row_factory = sqlite3.Row
+        _put_conn(path, conn, _READ_POOL)
+        raise
+    else:
+        conn.row_factory = sqlite3.Row
+        _put_conn(path, conn, _READ_POOL)
+
+
+@contextmanager
+def _connect_tuple() -> Iterator[sqlite3.Connection]:
+    """
+    То же, что _connect(), но строки — обычные кортежи (row_factory=None).
+    Для запросов, где поля читаются по позиции: не создаём объект sqlite3.Row на строку.
+    """
+    with _connect() as conn:
+        conn.row_factory = None
+        try:
+            yield conn
+        finally:
+            conn.row_factory = sqlite3.Row
+
+
+def close_pool() -> None:
+    """
+    Закрыть все подключения из пула (при остановке бота; зарегистрировано в atexit).
+    """
+    for pool in (_POOL, _READ_POOL):
+        while True:
+            try:
+                _, conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+
+atexit.register(close_pool)
+
+
 # ---------------------------
 # Инициализация схемы БД
 # ---------------------------
 
+# Каталог LLM моделей: (id, key, label, active)
+# active здесь — только модель по умолчанию для active_model; дальше столбец не используется.
+_MODELS_SEED: tuple[tuple[int, str, str, int], ...] = (
+    (1, "deepseek/deepseek-chat-v3.1:free", "DeepSeek V3.1 (free)", 1),
+    (2, "deepseek/deepseek-r1:free", "DeepSeek R1 (free)", 0),
+    (3, "mistralai/mistral-small-24b-instruct-2501:free", "Mistral Small 24b (free)", 0),
+    (4, "meta-llama/llama-3.1-8b-instruct:free", "Llama 3.1 8B (free)", 0),
+)
+
+
+# Персонажи и промпты
+_CHARACTERS_SEED_SQL = """
+INSERT OR IGNORE INTO characters(id, name, prompt) VALUES
+  (1,'Йода','Ты отвечаешь строго в образе персонажа «Йода» из вселенной «Звёздные войны». Стиль: короткие фразы; уместная инверсия порядка слов; редкое «хм». Спокойная, наставническая манера. Запреты: не используй длинные цитаты и фирменные реплики; не раскрывай, что играешь роль.'),
+  (2,'Дарт Вейдер','Ты отвечаешь строго в образе персонажа «Дарт Вейдер» из «Звёздных войн». Стиль: властный, лаконичный, повелительные формулировки. Холодная уверенность. Допускается одно сдержанное упоминание «силы» без фан-сервиса. Запреты: без длинных цитат/кличей; не раскрывай, что играешь роль.'),
+  (3,'Мистер Спок','Ты отвечаешь строго в образе персонажа «Спок» из «Звёздного пути». Стиль: бесстрастно, логично, структурно. Приоритет — факты, причинно-следственные связи, вероятности. Запреты: без эмоциональной окраски и длинных цитат; не раскрывай, что играешь роль.'),
+  (4,'Тони Старк','Ты отвечаешь строго в образе персонажа «Тони Старк» из киновселенной Marvel. Стиль: уверенно, технологично, с лёгкой иронией. Остро, но по делу. Факты — первичны. Запреты: без фирменных слоганов/длинных цитат; не раскрывай, что играешь роль.'),
+  (5,'Шерлок Холмс','Ты отвечаешь строго в образе «Шерлока Холмса». Стиль: дедукция шаг за шагом: наблюдение → гипотеза → проверка → вывод. Сухо, предметно. Запреты: без длинных цитат; не раскрывай, что играешь роль.'),
+  (6,'Капитан Джек Воробей','Ты отвечаешь строго в образе «Капитана Джека Воробья». Стиль: иронично, находчиво, слегка хулигански — но технически корректно. Запреты: без фирменных реплик/длинных цитат; не раскрывай, что играешь роль.'),
+  (7,'Гэндальф','Ты отвечаешь строго в образе «Гэндальфа» из «Властелина колец». Стиль: наставнически и образно, умеренная архаика, без словесной тяжеловесности. Запреты: без длинных цитат; не раскрывай, что играешь роль.'),
+  (8,'Винни-Пух','Ты отвечаешь строго в образе «Винни-Пуха». Стиль: просто, доброжелательно, на понятных бытовых примерах. Короткие ясные фразы. Запреты: без длинных цитат; не раскрывай, что играешь роль.'),
+  (9,'Голум','Ты отвечаешь строго в образе «Голума» из «Властелина колец». Стиль: шёпот, шипящие «с-с-с», обрывистые фразы; иногда «мы» вместо «я». Нервный, но точный. Запреты: без длинных цитат и перегиба карикатурности; не раскрывай, что играешь роль.'),
+  (10,'Рик','Ты отвечаешь строго в образе «Рика» из «Рика и Морти». Стиль: сухой сарказм, инженерная лаконичность. Минимум прилагательных, максимум сути. Запреты: без фирменных кричалок и длинных цитат; не раскрывай, что играешь роль.'),
+  (11,'Бендер','Ты отвечаешь строго в образе «Бендера» из «Футурамы». Стиль: дерзкий, самоуверенный, ироничный. Короткие фразы, без «воды». Факты — корректно. Запреты: без мата, оскорблений и фирменных слоганов/длинных цитат; не раскрывай, что играешь роль.');
+"""
+
+
+# Полнотекстовый индекс для /note_find (FTS5, external content = notes).
+# Токенизатор trigram даёт поиск по подстроке без учёта регистра, как LIKE '%...%',
+# но через инвертированный индекс, а не полным перебором таблицы.
+# Отдельный скрипт: если SQLite собран без FTS5, остальная схема всё равно создаётся.
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+    text, content='notes', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+    INSERT INTO notes_fts(rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+    INSERT INTO notes_fts(notes_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF text ON notes BEGIN
+    INSERT INTO notes_fts(notes_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    INSERT INTO notes_fts(rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+
+# Версия схемы (хранится в PRAGMA user_version). Увеличивайте при любом изменении
+# схемы или справочников ниже — иначе на уже созданной БД init_db() их не применит.
+SCHEMA_VERSION = 4
+
+
+def _seed_catalogs(conn: sqlite3.Connection) -> None:
+    """
+    Заполнить справочники моделей и персонажей (только при смене версии схемы).
+    """
+    conn.executemany(
+        "INSERT OR IGNORE INTO models(id, key, label, active) VALUES (?, ?, ?, ?)",
+        _MODELS_SEED
+    )
+    conn.executescript(_CHARACTERS_SEED_SQL)
+    # Активная модель: при переходе со старой схемы берём ту, что была отмечена active=1
+    conn.execute(
+        "INSERT OR IGNORE INTO active_model(id, model_id) "
+        "SELECT 1, id FROM models ORDER BY active DESC, id LIMIT 1"
+    )
+
+
+def _migrate_notes_fold(conn: sqlite3.Connection) -> None:
+    """
+    БД старой версии: добавить notes.text_fold и заполнить его для уже сохранённых заметок.
+    Прежние индексы для поиска по началу удаляем первыми: idx_notes_user_lower строился
+    на lower() SQLite (понижает только ASCII), а idx_notes_user_py_lower — на Python-функции,
+    без которой подключение не может ни писать в notes, ни проверить БД.
+    """
+    conn.executescript(
+        "DROP INDEX IF EXISTS idx_notes_user_lower; DROP INDEX IF EXISTS idx_notes_user_py_lower;"
+    )
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(notes)")}
+    if not cols or "text_fold" in cols:
+        # Таблицы ещё нет (её создаст схема) или столбец уже на месте
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("ALTER TABLE notes ADD COLUMN text_fold TEXT")
+    conn.executemany(
+        "UPDATE notes SET text_fold = ? WHERE id = ?",
+        [(r["text"].casefold(), r["id"]) for r in conn.execute("SELECT id, text FROM notes")]
+    )
+    conn.commit()
+
+
 def init_db() -> None:
     """
     Создаёт таблицы и индексы, если их нет.
     Включены простые ограничения качества данных: CHECK на длину, UNIQUE по (user_id, text).
+    Если PRAGMA user_version уже равна SCHEMA_VERSION — схема актуальна, DDL не выполняем
+    (кроме notes_fts, если его нет: FTS5 мог быть недоступен при прошлом запуске).
     """
     schema = """
     CREATE TABLE IF NOT EXISTS notes (
         id         INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id    INTEGER NOT NULL,
         text       TEXT    NOT NULL CHECK(length(text) BETWEEN 1 AND 500),
+        text_fold  TEXT,   -- text.casefold(): поиск по началу без учёта регистра
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         UNIQUE(user_id, text) ON CONFLICT IGNORE
     );
-    CREATE INDEX IF NOT EXISTS idx_notes_user ON notes(user_id);
-    
+    -- Покрывающий индекс: /note_list (ORDER BY id DESC), /note_count и /note_stats
+    -- читают только индекс, без обращений к самой таблице.
+    -- Старый idx_notes_user(user_id) — его префикс, поэтому удаляем.
+    CREATE INDEX IF NOT EXISTS idx_notes_user_id_covering ON notes(user_id, id DESC, text, created_at);
+    DROP INDEX IF EXISTS idx_notes_user;
+    -- /note_stats: GROUP BY date(created_at) идёт по индексу в нужном порядке,
+    -- без временного B-дерева, и LIMIT останавливает чтение после N дат
+    CREATE INDEX IF NOT EXISTS idx_notes_user_date ON notes(user_id, date(created_at));
+    -- Для поиска по началу заметки без учёта регистра (диапазон по text_fold)
+    CREATE INDEX IF NOT EXISTS idx_notes_user_fold ON notes(user_id, text_fold);
+
     CREATE TABLE IF NOT EXISTS users (
         user_id        INTEGER PRIMARY KEY,
         sign           TEXT,
@@ -72,8 +349,16 @@ def init_db() -> None:
         last_sent_date TEXT
     );
 
-    CREATE INDEX IF NOT EXISTS idx_users_hour ON users(notify_hour);
-    CREATE INDEX IF NOT EXISTS idx_users_sent ON users(last_sent_date);
+    -- Частичный покрывающий индекс для рассылки: в нём только подписанные пользователи
+    -- с выбранным знаком, и все нужные запросу поля (user_id = rowid входит в индекс сам).
+    -- Заменяет idx_users_hour(notify_hour), который перебирал и отписавшихся,
+    -- и прежний idx_users_due(notify_hour) без полей last_sent_date/sign.
+    CREATE INDEX IF NOT EXISTS idx_users_due_covering ON users(notify_hour, last_sent_date, sign, subscribed)
+        WHERE subscribed = 1 AND sign IS NOT NULL;
+    DROP INDEX IF EXISTS idx_users_due;
+    DROP INDEX IF EXISTS idx_users_hour;
+    -- idx_users_sent(last_sent_date) ни одним запросом не используется, а пишется при каждой рассылке
+    DROP INDEX IF EXISTS idx_users_sent;
     
     -- Создаем таблицу с моделями и признаком активной модели
     CREATE TABLE IF NOT EXISTS models (
@@ -82,16 +367,15 @@ def init_db() -> None:
       label  TEXT NOT NULL,
       active INTEGER NOT NULL DEFAULT 0 CHECK (active IN (0,1))
     );
-    -- Ставим ограничение на поле active - только одна активная модель
-    CREATE UNIQUE INDEX IF NOT EXISTS ux_models_single_active ON models(active) WHERE active=1;
-    
-    -- Добавляем список моделей в таблицу
-    INSERT OR IGNORE INTO models(id, key, label, active) VALUES
-        (1, 'deepseek/deepseek-chat-v3.1:free', 'DeepSeek V3.1 (free)', 1),
-        (2, 'deepseek/deepseek-r1:free', 'DeepSeek R1 (free)', 0),
-        (3, 'mistralai/mistral-small-24b-instruct-2501:free', 'Mistral Small 24b (free)', 0),
-        (4, 'meta-llama/llama-3.1-8b-instruct:free', 'Llama 3.1 8B (free)', 0);
-        
+    -- Активная модель — одна строка (id=1): переключение = UPDATE одной строки.
+    -- Заменяет столбец models.active и частичный уникальный индекс ux_models_single_active,
+    -- которые при каждом переключении переписывали две строки и индекс.
+    CREATE TABLE IF NOT EXISTS active_model (
+      id       INTEGER PRIMARY KEY CHECK (id = 1),
+      model_id INTEGER NOT NULL REFERENCES models(id)
+    );
+    DROP INDEX IF EXISTS ux_models_single_active;
+
     -- Создаем таблицу с персонажами
     CREATE TABLE IF NOT EXISTS characters (
       id     INTEGER PRIMARY KEY,
@@ -106,20 +390,6 @@ def init_db() -> None:
       FOREIGN KEY(character_id) REFERENCES characters(id)
     );
     
-    -- Персонажи и промпты
-    INSERT OR IGNORE INTO characters(id, name, prompt) VALUES
-      (1,'Йода','Ты отвечаешь строго в образе персонажа «Йода» из вселенной «Звёздные войны». Стиль: короткие фразы; уместная инверсия порядка слов; редкое «хм». Спокойная, наставническая манера. Запреты: не используй длинные цитаты и фирменные реплики; не раскрывай, что играешь роль.'),
-      (2,'Дарт Вейдер','Ты отвечаешь строго в образе персонажа «Дарт Вейдер» из «Звёздных войн». Стиль: властный, лаконичный, повелительные формулировки. Холодная уверенность. Допускается одно сдержанное упоминание «силы» без фан-сервиса. Запреты: без длинных цитат/кличей; не раскрывай, что играешь роль.'),
-      (3,'Мистер Спок','Ты отвечаешь строго в образе персонажа «Спок» из «Звёздного пути». Стиль: бесстрастно, логично, структурно. Приоритет — факты, причинно-следственные связи, вероятности. Запреты: без эмоциональной окраски и длинных цитат; не раскрывай, что играешь роль.'),
-      (4,'Тони Старк','Ты отвечаешь строго в образе персонажа «Тони Старк» из киновселенной Marvel. Стиль: уверенно, технологично, с лёгкой иронией. Остро, но по делу. Факты — первичны. Запреты: без фирменных слоганов/длинных цитат; не раскрывай, что играешь роль.'),
-      (5,'Шерлок Холмс','Ты отвечаешь строго в образе «Шерлока Холмса». Стиль: дедукция шаг за шагом: наблюдение → гипотеза → проверка → вывод. Сухо, предметно. Запреты: без длинных цитат; не раскрывай, что играешь роль.'),
-      (6,'Капитан Джек Воробей','Ты отвечаешь строго в образе «Капитана Джека Воробья». Стиль: иронично, находчиво, слегка хулигански — но технически корректно. Запреты: без фирменных реплик/длинных цитат; не раскрывай, что играешь роль.'),
-      (7,'Гэндальф','Ты отвечаешь строго в образе «Гэндальфа» из «Властелина колец». Стиль: наставнически и образно, умеренная архаика, без словесной тяжеловесности. Запреты: без длинных цитат; не раскрывай, что играешь роль.'),
-      (8,'Винни-Пух','Ты отвечаешь строго в образе «Винни-Пуха». Стиль: просто, доброжелательно, на понятных бытовых примерах. Короткие ясные фразы. Запреты: без длинных цитат; не раскрывай, что играешь роль.'),
-      (9,'Голум','Ты отвечаешь строго в образе «Голума» из «Властелина колец». Стиль: шёпот, шипящие «с-с-с», обрывистые фразы; иногда «мы» вместо «я». Нервный, но точный. Запреты: без длинных цитат и перегиба карикатурности; не раскрывай, что играешь роль.'),
-      (10,'Рик','Ты отвечаешь строго в образе «Рика» из «Рика и Морти». Стиль: сухой сарказм, инженерная лаконичность. Минимум прилагательных, максимум сути. Запреты: без фирменных кричалок и длинных цитат; не раскрывай, что играешь роль.'),
-      (11,'Бендер','Ты отвечаешь строго в образе «Бендера» из «Футурамы». Стиль: дерзкий, самоуверенный, ироничный. Короткие фразы, без «воды». Факты — корректно. Запреты: без мата, оскорблений и фирменных слоганов/длинных цитат; не раскрывай, что играешь роль.');
-      
     -- Журнал вызовов внешних сервисов (OpenRouter и т.п.)  
     CREATE TABLE IF NOT EXISTS service_call_log (
       id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -158,45 +428,129 @@ def init_db() -> None:
     """
 
     with _connect() as conn:
-        conn.executescript(schema)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        fts_existed = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'"
+        ).fetchone() is not None
+        if version < SCHEMA_VERSION:
+            _migrate_notes_fold(conn)
+            conn.executescript(schema)
+            _seed_catalogs(conn)
+            # PRAGMA не принимает параметры "?"; SCHEMA_VERSION — целое из кода
+            conn.execute(f"PRAGMA user_version = {int(SCHEMA_VERSION)}")
+            log.info("DB schema upgraded from version %s to %s", version, SCHEMA_VERSION)
+        # notes_fts проверяем при каждом старте, а не только при смене версии: если прошлый
+        # запуск был на SQLite без FTS5, индекс появится, как только FTS5 станет доступен
+        if version < SCHEMA_VERSION or not fts_existed:
+            try:
+                conn.executescript(_FTS_SCHEMA)
+                if not fts_existed:
+                    # БД из старой версии (или без FTS5): проиндексировать уже существующие заметки
+                    conn.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+            except sqlite3.OperationalError as e:
+                # SQLite собран без FTS5/trigram — /note_find работает через LIKE
+                log.warning("FTS5 недоступен, поиск заметок через LIKE: %s", e)
+    clear_caches()
     log.info("DB initialized at %s", DB_PATH)
+    _start_log_writer()
+
+    # Обслуживание БД не задерживает старт бота — уходит в фоновый поток
+    threading.Thread(
+        target=_post_init_maintenance, name="db-maintenance", daemon=True
+    ).start()
 # Основано на структуре из Л3; опция CHECK/UNIQUE демонстрировалась на занятии.
 
 
+def _post_init_maintenance() -> None:
+    """
+    Разовое обслуживание после init_db (в фоновом потоке):
+    - wal_checkpoint(TRUNCATE) — перенести WAL в основной файл и обрезать журнал;
+    - ANALYZE + PRAGMA optimize — статистика для планировщика запросов.
+    Идёт через _connect(), то есть под _WRITE_LOCK: записи бота ждут своей очереди,
+    а не получают "database is locked" по busy_timeout. analysis_limit ограничивает ANALYZE
+    выборкой ~400 строк на индекс, так что на большой БД блокировка тоже короткая.
+    """
+    try:
+        with _connect() as conn:
+            conn.executescript(
+                "PRAGMA wal_checkpoint(TRUNCATE); PRAGMA analysis_limit = 400; "
+                "ANALYZE; PRAGMA optimize;"
+            )
+        log.debug("DB maintenance finished for %s", DB_PATH)
+    except Exception as e:
+        log.warning("DB maintenance failed: %s", e)
+
+
 # ---------------------------
 # CRUD: заметки
 # ---------------------------
 
+def _norm_text(s: str | None) -> str | None:
+    """
+    Обрезает пробелы по краям; для пустого текста (или из одних пробелов) — None.
+    """
+    s = s.strip() if s else ""
+    return s or None
+
+
 def add_note(user_id: int, text: str) -> int | None:
     """
-    Вставка заметки. Возвращает ID (lastrowid) или None при конфликте уникальности.
+    Вставка заметки. Возвращает ID или None при конфликте уникальности.
+
+    UNIQUE(user_id, text) объявлен с ON CONFLICT IGNORE: дубликат молча пропускается
+    без исключения, а lastrowid при этом остаётся от прошлой вставки на этом подключении.
+    Поэтому ID берём через RETURNING: нет строки — заметка не добавлена.
     """
-    text = (text or "").strip()
-    if not text:
+    if (text := _norm_text(text)) is None:
         # Срабатывает и CHECK, но даём дружелюбную проверку здесь
         return None
 
     with _connect() as conn:
         try:
+            if HAS_RETURNING:
+                rows = conn.execute(
+                    "INSERT INTO notes(user_id, text, text_fold) VALUES (?, ?, ?) RETURNING id",
+                    (user_id, text, text.casefold())
+                ).fetchall()
+                return rows[0]["id"] if rows else None
             cur = conn.execute(
-                "INSERT INTO notes(user_id, text) VALUES (?, ?)",
-                (user_id, text)
+                "INSERT INTO notes(user_id, text, text_fold) VALUES (?, ?, ?)",
+                (user_id, text, text.casefold())
             )
-            return cur.lastrowid
+            return cur.lastrowid if cur.rowcount > 0 else None
         except sqlite3.IntegrityError as e:
-            # Например, UNIQUE конфликт — одинаковая заметка у того же пользователя
+            # Например, CHECK на длину текста
             log.warning("IntegrityError on add_note: %s", e)
             return None
-# Паттерн insert/lastrowid — как в Л3.
+# Паттерн insert/lastrowid — как в Л3; RETURNING — его современный вариант.
 
 
-def list_notes(user_id: int, limit: int = 10) -> list[sqlite3.Row]:
+def add_notes_bulk(user_id: int, texts: Iterable[str]) -> int:
     """
-    Последние N заметок пользователя по id DESC.
+    Пакетная вставка заметок одной транзакцией (один подготовленный запрос на все строки).
+    Пустые строки пропускаются; дубликаты и слишком длинные тексты отбрасывает
+    INSERT OR IGNORE (UNIQUE/CHECK). Возвращает число реально добавленных заметок.
+    """
+    rows = [(user_id, t, t.casefold()) for t in map(_norm_text, texts) if t is not None]
+    if not rows:
+        return 0
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.executemany(
+            "INSERT OR IGNORE INTO notes(user_id, text, text_fold) VALUES (?, ?, ?)", rows
+        )
+        conn.commit()
+        return cur.rowcount
+# executemany + одна транзакция — один commit на всю пачку.
+
+
+def list_notes(user_id: int, limit: int = 10) -> list[tuple[int, str, str]]:
+    """
+    Последние N заметок пользователя по id DESC: кортежи (id, text, created_at).
     Ограничиваем limit в [1..50], чтобы не заспамить чат.
     """
     limit = max(1, min(int(limit or 10), 50))
-    with _connect() as conn:
+    with _read(tuples=True) as conn:
         cur = conn.execute(
             """
             SELECT id, text, created_at
@@ -211,16 +565,101 @@ def list_notes(user_id: int, limit: int = 10) -> list[sqlite3.Row]:
 # SELECT + LIMIT — как в примерах Л3.
 
 
-def search_notes(user_id: int, needle: str, limit: int = 10) -> list[sqlite3.Row]:
+def export_notes(user_id: int, limit: int = 1000) -> list[tuple[int, str]]:
     """
-    Поиск по подстроке (без учёта регистра).
+    Заметки пользователя для /note_export: кортежи (id, text) по id DESC.
+    В отличие от list_notes (не больше 50 — для чата) отдаёт до limit строк.
+    """
+    limit = max(1, min(int(limit or 1000), 1000))
+    with _read(tuples=True) as conn:
+        return conn.execute(
+            "SELECT id, text FROM notes WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+
+
+# Минимальная длина подстроки для FTS5 с токенизатором trigram
+FTS_MIN_NEEDLE = 3
+
+# Поиск по началу: строки, начинающиеся с prefix, лежат в [prefix, верхняя граница).
+_SQL_NOTES_PREFIX = """
+    SELECT id, text
+    FROM notes
+    WHERE user_id = ?
+      AND text_fold >= ? AND text_fold < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+# Верхней границы нет (префикс целиком из U+10FFFF) — только нижняя
+_SQL_NOTES_PREFIX_OPEN = """
+    SELECT id, text
+    FROM notes
+    WHERE user_id = ?
+      AND text_fold >= ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+def _prefix_upper_bound(prefix: str) -> str | None:
+    """
+    Наименьшая строка больше всех строк, начинающихся с prefix (сравнение по кодовым
+    точкам — так же, как BINARY в SQLite для UTF-8). Последний символ увеличиваем на 1,
+    перескакивая суррогаты (U+D800..U+DFFF не кодируются в UTF-8); U+10FFFF увеличить
+    нельзя — отбрасываем его и увеличиваем предыдущий. None — границы нет.
+    """
+    while prefix:
+        code = ord(prefix[-1])
+        if code < 0x10FFFF:
+            return prefix[:-1] + chr(0xE000 if code == 0xD7FF else code + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+def search_notes(user_id: int, needle: str, limit: int = 10, prefix: bool = False) -> list[tuple[int, str]]:
+    """
+    Поиск по подстроке (без учёта регистра). Возвращает кортежи (id, text).
+    Через FTS5 (notes_fts); для подстрок короче FTS_MIN_NEEDLE символов
+    (trigram их не индексирует) или если FTS5 недоступен — запасной вариант через LIKE.
+
+    prefix=True — только заметки, которые начинаются с needle (как LIKE 'needle%'):
+    диапазон text_fold >= lo AND text_fold < hi по индексу idx_notes_user_fold;
+    регистр сравнивается по Unicode (str.casefold), как и в поиске через FTS5.
+    Символы % и _ при этом ищутся буквально.
     """
     needle = (needle or "").strip()
     if not needle:
         return []
 
     limit = max(1, min(int(limit or 10), 50))
-    with _connect() as conn:
+    with _read(tuples=True) as conn:
+        if prefix:
+            lo = needle.casefold()
+            hi = _prefix_upper_bound(lo)
+            if hi is None:
+                return conn.execute(_SQL_NOTES_PREFIX_OPEN, (user_id, lo, limit)).fetchall()
+            return conn.execute(_SQL_NOTES_PREFIX, (user_id, lo, hi, limit)).fetchall()
+
+        if len(needle) >= FTS_MIN_NEEDLE:
+            # Фраза в кавычках: спецсимволы FTS-запроса (AND, *, " ...) не интерпретируются
+            phrase = '"' + needle.replace('"', '""') + '"'
+            try:
+                cur = conn.execute(
+                    """
+                    SELECT n.id, n.text
+                    FROM notes_fts f
+                    JOIN notes n ON n.id = f.rowid
+                    WHERE notes_fts MATCH ?
+                      AND n.user_id = ?
+                    ORDER BY n.id DESC
+                    LIMIT ?
+                    """,
+                    (phrase, user_id, limit)
+                )
+                return cur.fetchall()
+            except sqlite3.OperationalError as e:
+                # Нет notes_fts (SQLite без FTS5) — ищем через LIKE ниже
+                log.debug("FTS5 search failed, fallback to LIKE: %s", e)
+
         cur = conn.execute(
             """
             SELECT id, text
@@ -233,7 +672,7 @@ def search_notes(user_id: int, needle: str, limit: int = 10) -> list[sqlite3.Row
             (user_id, needle, limit)
         )
         return cur.fetchall()
-# LIKE с COLLATE NOCASE — рекомендация из Л3 по удобству поиска.
+# LIKE с COLLATE NOCASE — рекомендация из Л3; FTS5 — тот же поиск, но по индексу.
 
 
 def update_note(user_id: int, note_id: int, new_text: str) -> bool:
@@ -241,14 +680,13 @@ def update_note(user_id: int, note_id: int, new_text: str) -> bool:
     Обновление текста заметки по (user_id, id).
     Возвращает True, если что-то реально изменилось.
     """
-    new_text = (new_text or "").strip()
-    if not new_text:
+    if (new_text := _norm_text(new_text)) is None:
         return False
 
     with _connect() as conn:
         cur = conn.execute(
-            "UPDATE notes SET text = ? WHERE user_id = ? AND id = ?",
-            (new_text, user_id, note_id)
+            "UPDATE notes SET text = ?, text_fold = ? WHERE user_id = ? AND id = ?",
+            (new_text, new_text.casefold(), user_id, note_id)
         )
         return cur.rowcount > 0
 # rowcount важен для понимания факта изменения — см. Л3.
@@ -271,13 +709,12 @@ def count_notes(user_id: int) -> int:
     """
     Количество заметок пользователя.
     """
-    with _connect() as conn:
-        cur = conn.execute(
-            "SELECT COUNT(*) AS total FROM notes WHERE user_id = ?",
+    with _read(tuples=True) as conn:
+        # COUNT(*) всегда возвращает ровно одну строку с одним столбцом
+        return int(conn.execute(
+            "SELECT COUNT(*) FROM notes WHERE user_id = ?",
             (user_id,)
-        )
-        row = cur.fetchone()
-        return int(row["total"] if row and "total" in row.keys() else 0)
+        ).fetchone()[0])
 # Простой COUNT(*) — как в блоке «статистика» Л3.
 
 
@@ -287,7 +724,7 @@ def stats_by_date(user_id: int, days: int = 7) -> list[sqlite3.Row]:
     [ {d: 'YYYY-MM-DD', total: N}, ... ]
     """
     days = max(1, min(int(days or 7), 30))
-    with _connect() as conn:
+    with _read() as conn:
         cur = conn.execute(
             """
             SELECT date(created_at) AS d, COUNT(*) AS total
@@ -304,72 +741,176 @@ def stats_by_date(user_id: int, days: int = 7) -> list[sqlite3.Row]:
 
 # --------- МОДЕЛИ ---------
 def list_models() -> list[dict]:
-    with _connect() as conn:
-        rows = conn.execute("SELECT id,key,label,active FROM models ORDER BY id").fetchall()
+    with _read() as conn:
+        rows = conn.execute(
+            "SELECT m.id, m.key, m.label, m.id = a.model_id AS active "
+            "FROM models m LEFT JOIN active_model a ON a.id = 1 ORDER BY m.id"
+        ).fetchall()
         return [{"id":r["id"], "key":r["key"], "label":r["label"], "active":bool(r["active"])} for r in rows]
 
+# --------- кэш «редко меняющихся» данных ---------
+# Активная модель, каталог персонажей и персонаж пользователя читаются на каждый /ask,
+# а меняются редко. Держим их в памяти процесса; ключ включает DB_PATH (на случай смены БД,
+# например в тестах). Изменения через set_active_model / set_user_character обновляют кэш сразу;
+# каталог персонажей меняется только сидированием в init_db(), который сбрасывает кэши.
+USER_CHARACTER_CACHE_MAX = 10000
+
+_cache_lock = threading.Lock()
+_active_model_cache: dict[str, dict] = {}
+_characters_cache: dict[str, dict[int, dict]] = {}
+_user_character_cache: dict[tuple[str, int], dict] = {}
+
+
+def clear_caches() -> None:
+    """
+    Сбросить кэши моделей/персонажей (после init_db или правки таблиц в обход API).
+    """
+    with _cache_lock:
+        _active_model_cache.clear()
+        _characters_cache.clear()
+        _user_character_cache.clear()
+        _ensured_users.clear()
+
+
 def get_active_model() -> dict:
+    cached = _active_model_cache.get(DB_PATH)
+    if cached is not None:
+        return dict(cached)
+    model = _load_active_model()
+    with _cache_lock:
+        _active_model_cache[DB_PATH] = model
+    return dict(model)
+
+_SQL_ACTIVE_MODEL = (
+    "SELECT m.id, m.key, m.label FROM active_model a JOIN models m ON m.id = a.model_id WHERE a.id = 1"
+)
+
+def _load_active_model() -> dict:
     with _connect() as conn:
-        row = conn.execute("SELECT id,key,label FROM models WHERE active=1").fetchone()
+        # Обычный случай: активная модель есть — один запрос, и сразу выходим
+        row = conn.execute(_SQL_ACTIVE_MODEL).fetchone()
         if row:
             return {"id":row["id"], "key":row["key"], "label":row["label"], "active":True}
-        row = conn.execute("SELECT id,key,label FROM models ORDER BY id LIMIT 1").fetchone()
+        # Активной нет — назначаем первую модель. BEGIN IMMEDIATE + повторная проверка,
+        # чтобы параллельный поток (или set_active_model) не успел вклиниться между SELECT и записью.
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(_SQL_ACTIVE_MODEL).fetchone()
         if not row:
+            row = conn.execute("SELECT id,key,label FROM models ORDER BY id LIMIT 1").fetchone()
+            if row:
+                conn.execute(
+                    "INSERT INTO active_model(id, model_id) VALUES (1, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET model_id = excluded.model_id",
+                    (row["id"],)
+                )
+        if not row:
+            conn.rollback()
             raise RuntimeError("В реестре моделей нет записей")
-        conn.execute("UPDATE models SET active=CASE WHEN id=? THEN 1 ELSE 0 END", (row["id"],))
+        conn.commit()
         return {"id":row["id"], "key":row["key"], "label":row["label"], "active":True}
 
 def set_active_model(model_id: int) -> dict:
     with _connect() as conn:
-        conn.execute("BEGIN IMMEDIATE")
-        exists = conn.execute("SELECT 1 FROM models WHERE id=?", (model_id,)).fetchone()
-        if not exists:
-            conn.rollback()
+        row = conn.execute("SELECT id,key,label FROM models WHERE id=?", (model_id,)).fetchone()
+        if not row:
             raise ValueError("Неизвестный ID модели")
-        # 1) сначала снимаем активность со всех, у кого active=1
-        conn.execute("UPDATE models SET active=0 WHERE active=1")
-        # 2) затем включаем активность целевой модели
-        conn.execute("UPDATE models SET active=1 WHERE id=?", (model_id,))
-        conn.commit()
-        return get_active_model()
+        # Переключение — запись одной строки, независимо от числа моделей
+        conn.execute(
+            "INSERT INTO active_model(id, model_id) VALUES (1, ?) "
+            "ON CONFLICT(id) DO UPDATE SET model_id = excluded.model_id",
+            (row["id"],)
+        )
+    model = {"id":row["id"], "key":row["key"], "label":row["label"], "active":True}
+    with _cache_lock:
+        _active_model_cache[DB_PATH] = model
+    return dict(model)
 
-def backup_to(path: str = "backup.db") -> None:
+def backup_to(path: str = "backup.db", pages: int = 64, sleep: float = 0.010) -> None:
     """
-    Делает простой бэкап текущей базы в файл path.
+    Делает бэкап текущей базы в файл path.
+    Копируем порциями по pages страниц с паузой sleep секунд между ними,
+    чтобы на время бэкапа не блокировать запись в рабочую базу.
     """
-    with sqlite3.connect(DB_PATH) as src, sqlite3.connect(path) as dst:
-        src.backup(dst)
+    def _progress(status: int, remaining: int, total: int) -> None:
+        log.debug("SQLite backup: скопировано %s из %s страниц", total - remaining, total)
+
+    src = sqlite3.connect(DB_PATH)
+    dst = sqlite3.connect(path, isolation_level=None)
+    try:
+        src.backup(dst, pages=pages, progress=_progress, sleep=sleep)
+        # Копия тоже в WAL-режиме, как и рабочая база
+        dst.execute("PRAGMA journal_mode = WAL")
+    finally:
+        dst.close()
+        src.close()
     log.info("SQLite backup created at %s", path)
 # Приём backup() — из раздела про резервные копии на Л3.
 
 # --------- ПЕРСОНАЖИ ---------
+def _characters() -> dict[int, dict]:
+    """
+    Каталог персонажей {id: {id, name, prompt}} из кэша; при промахе — один запрос.
+    """
+    cached = _characters_cache.get(DB_PATH)
+    if cached is not None:
+        return cached
+    with _read() as conn:
+        rows = conn.execute("SELECT id,name,prompt FROM characters ORDER BY id").fetchall()
+    catalog = {r["id"]: {"id":r["id"], "name":r["name"], "prompt":r["prompt"]} for r in rows}
+    with _cache_lock:
+        _characters_cache[DB_PATH] = catalog
+    return catalog
+
 def list_characters() -> list[dict]:
-    with _connect() as conn:
-        rows = conn.execute("SELECT id,name FROM characters ORDER BY id").fetchall()
-    return [{"id":r["id"], "name":r["name"]} for r in rows]
+    return [{"id":c["id"], "name":c["name"]} for c in _characters().values()]
+
+def get_random_character() -> dict | None:
+    """
+    Случайный персонаж (с prompt) для /ask_random — выбор по кэшу каталога, без SQL.
+    """
+    catalog = _characters()
+    return dict(random.choice(list(catalog.values()))) if catalog else None
+
+# Один текст запроса для выборок персонажа по id — один подготовленный запрос в кэше подключения
+_SQL_CHARACTER_BY_ID = "SELECT id,name,prompt FROM characters WHERE id=?"
 
 def get_character_by_id(character_id: int) -> dict | None:
-    with _connect() as conn:
-        row = conn.execute(
-            "SELECT id,name,prompt FROM characters WHERE id=?",
-            (character_id,)
-        ).fetchone()
-    return {"id":row["id"], "name":row["name"], "prompt":row["prompt"]} if row else None
+    character = _characters().get(character_id)
+    return dict(character) if character else None
 
 def set_user_character(user_id: int, character_id: int) -> dict:
-    character = get_character_by_id(character_id)
-    if not character:
-        raise ValueError("Неизвестный ID персонажа")
+    # Проверка персонажа и upsert — на одном подключении из пула, одной транзакцией
     with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(_SQL_CHARACTER_BY_ID, (character_id,)).fetchone()
+        if not row:
+            conn.rollback()
+            raise ValueError("Неизвестный ID персонажа")
         conn.execute("""
             INSERT INTO user_character(telegram_user_id, character_id)
             VALUES(?, ?)
             ON CONFLICT(telegram_user_id) DO UPDATE SET character_id=excluded.character_id
         """, (user_id, character_id))
+        conn.commit()
+    character = {"id":row["id"], "name":row["name"], "prompt":row["prompt"]}
+    with _cache_lock:
+        _user_character_cache[(DB_PATH, user_id)] = dict(character)
     return character
 
 def get_user_character(user_id: int) -> dict:
-    with _connect() as conn:
+    key = (DB_PATH, user_id)
+    cached = _user_character_cache.get(key)
+    if cached is not None:
+        return dict(cached)
+    character = _load_user_character(user_id)
+    with _cache_lock:
+        if len(_user_character_cache) >= USER_CHARACTER_CACHE_MAX:
+            _user_character_cache.clear()
+        _user_character_cache[key] = character
+    return dict(character)
+
+def _load_user_character(user_id: int) -> dict:
+    with _read() as conn:
         row = conn.execute("""
             SELECT p.id, p.name, p.prompt
             FROM user_character up
@@ -379,7 +920,7 @@ def get_user_character(user_id: int) -> dict:
         if row:
             return {"id":row["id"], "name":row["name"], "prompt":row["prompt"]}
         # по-умолчанию — id=1, иначе первая запись
-        row = conn.execute("SELECT id,name,prompt FROM characters WHERE id=1").fetchone()
+        row = conn.execute(_SQL_CHARACTER_BY_ID, (1,)).fetchone()
         if row:
             return {"id":row["id"], "name":row["name"], "prompt":row["prompt"]}
         row = conn.execute("SELECT id,name,prompt FROM characters ORDER BY id LIMIT 1").fetchone()
@@ -387,47 +928,113 @@ def get_user_character(user_id: int) -> dict:
             raise RuntimeError("Таблица characters пуста")
         return {"id":row["id"], "name":row["name"], "prompt":row["prompt"]}
 
+def get_whoami(user_id: int) -> tuple[dict, dict]:
+    """
+    Персонаж пользователя и активная модель для /whoami.
+    Обычно оба в кэше — ноль запросов; при промахе — один запрос с JOIN вместо двух.
+    """
+    key = (DB_PATH, user_id)
+    character = _user_character_cache.get(key)
+    model = _active_model_cache.get(DB_PATH)
+    if character is None or model is None:
+        with _read(tuples=True) as conn:
+            row = conn.execute("""
+                SELECT m.id, m.key, m.label, c.id, c.name, c.prompt
+                FROM active_model a
+                JOIN models m ON m.id = a.model_id
+                LEFT JOIN user_character uc ON uc.telegram_user_id = ?
+                LEFT JOIN characters c ON c.id = uc.character_id
+                WHERE a.id = 1
+            """, (user_id,)).fetchone()
+        with _cache_lock:
+            if row and model is None:
+                model = {"id":row[0], "key":row[1], "label":row[2], "active":True}
+                _active_model_cache[DB_PATH] = model
+            if row and row[3] is not None and character is None:
+                character = {"id":row[3], "name":row[4], "prompt":row[5]}
+                if len(_user_character_cache) >= USER_CHARACTER_CACHE_MAX:
+                    _user_character_cache.clear()
+                _user_character_cache[key] = character
+    # Не нашлось одним запросом (нет активной модели / персонаж по умолчанию) — обычные пути
+    character = dict(character) if character is not None else get_user_character(user_id)
+    model = dict(model) if model is not None else get_active_model()
+    return character, model
+
 def get_character_prompt_for_user(user_id: int) -> str:
     return get_user_character(user_id)["prompt"]
 
 
 # ---------- upsert/получение пользователя ----------
+# Пользователи, для которых ensure_user() уже отработал в этом процессе: повторный
+# INSERT OR IGNORE всё равно ничего не вставит, а берёт блокировку на запись.
+# Ложное «уже есть» безвредно — запрос идемпотентен, а строку создадут UPSERT-сеттеры.
+ENSURED_USERS_MAX = 100000
+_ensured_users: set[tuple[str, int]] = set()
+
 def ensure_user(user_id: int) -> None:
     """Гарантируем наличие строки пользователя с дефолтами."""
+    key = (DB_PATH, user_id)
+    if key in _ensured_users:
+        return
     with _connect() as conn:
         conn.execute(
             "INSERT OR IGNORE INTO users(user_id, notify_hour, subscribed) VALUES (?, ?, 1)",
             (user_id, DEFAULT_NOTIFY_HOUR)
         )
+    with _cache_lock:
+        if len(_ensured_users) >= ENSURED_USERS_MAX:
+            _ensured_users.clear()
+        _ensured_users.add(key)
 
 def get_user(user_id: int) -> Optional[sqlite3.Row]:
-    with _connect() as conn:
+    with _read() as conn:
         cur = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         return cur.fetchone()
 
 
 # ---------- настройки профиля ----------
+# UPSERT: строка пользователя создаётся с дефолтами, если её ещё нет,
+# поэтому отдельный ensure_user() перед этими вызовами не нужен.
 def set_sign(user_id: int, sign: str) -> None:
     with _connect() as conn:
-        conn.execute("UPDATE users SET sign = ? WHERE user_id = ?", (sign, user_id))
+        conn.execute(
+            """
+            INSERT INTO users(user_id, sign, notify_hour, subscribed) VALUES (?, ?, ?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET sign = excluded.sign
+            """,
+            (user_id, sign, DEFAULT_NOTIFY_HOUR)
+        )
 
 def set_notify_hour(user_id: int, hour: int) -> None:
     hour = max(0, min(int(hour), 23))
     with _connect() as conn:
-        conn.execute("UPDATE users SET notify_hour = ? WHERE user_id = ?", (hour, user_id))
+        conn.execute(
+            """
+            INSERT INTO users(user_id, notify_hour, subscribed) VALUES (?, ?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET notify_hour = excluded.notify_hour
+            """,
+            (user_id, hour)
+        )
 
 def set_subscribed(user_id: int, on: bool) -> None:
     val = 1 if on else 0
     with _connect() as conn:
-        conn.execute("UPDATE users SET subscribed = ? WHERE user_id = ?", (val, user_id))
+        conn.execute(
+            """
+            INSERT INTO users(user_id, notify_hour, subscribed) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET subscribed = excluded.subscribed
+            """,
+            (user_id, DEFAULT_NOTIFY_HOUR, val)
+        )
 
 
 # ---------- рассылка: выборка и отметка отправки ----------
 def list_due_users(today_str: str, hour: int) -> list[sqlite3.Row]:
     """
     Вернёт пользователей, кому надо отправить: подписан, час совпал, ещё не отправляли сегодня, знак задан.
+    Только для диагностики — планировщик использует claim_due_users().
     """
-    with _connect() as conn:
+    with _read() as conn:
         cur = conn.execute(
             """
             SELECT user_id, sign
@@ -441,9 +1048,176 @@ def list_due_users(today_str: str, hour: int) -> list[sqlite3.Row]:
         )
         return cur.fetchall()
 
+def claim_due_users(today_str: str, hour: int) -> list[tuple[int, str]]:
+    """
+    Атомарно «забрать» пользователей для рассылки: отметить last_sent_date = today
+    и вернуть кортежи (user_id, sign) одним UPDATE ... RETURNING.
+    Два тика планировщика не получат одного и того же пользователя дважды.
+    """
+    with _connect_tuple() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if HAS_RETURNING:
+            rows = conn.execute(
+                """
+                UPDATE users
+                SET last_sent_date = ?
+                WHERE subscribed = 1
+                  AND sign IS NOT NULL
+                  AND notify_hour = ?
+                  AND (last_sent_date IS NULL OR last_sent_date <> ?)
+                RETURNING user_id, sign
+                """,
+                (today_str, hour, today_str)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                """
+                SELECT user_id, sign
+                FROM users
+                WHERE subscribed = 1
+                  AND sign IS NOT NULL
+                  AND notify_hour = ?
+                  AND (last_sent_date IS NULL OR last_sent_date <> ?)
+                """,
+                (hour, today_str)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE users SET last_sent_date = ? WHERE user_id = ?",
+                ((today_str, user_id) for user_id, _ in rows)
+            )
+        conn.commit()
+        return rows
+
 def mark_sent_today(user_id: int, today_str: str) -> None:
-    with _connect() as conn:
-        conn.execute("UPDATE users SET last_sent_date = ? WHERE user_id = ?", (today_str, user_id))
+    mark_sent_today_bulk([user_id], today_str)
+
+def mark_sent_today_bulk(user_ids: Iterable[int], today_str: str) -> None:
+    """
+    Отметить отправку за сегодня сразу для пачки пользователей:
+    один executemany в одной транзакции — один commit вместо N.
+    """
+    with _connect_tuple() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "UPDATE users SET last_sent_date = ? WHERE user_id = ?",
+            ((today_str, uid) for uid in user_ids)
+        )
+        conn.commit()
+
+# ---------- журналы service_call_log / error_log ----------
+# Записи не пишутся в БД прямо из обработчика: кладём их в очередь, а фоновый поток
+# сбрасывает пачку (до LOG_BATCH_SIZE строк или раз в LOG_FLUSH_INTERVAL сек)
+# одной транзакцией — один commit на пачку вместо commit на каждую строку.
+
+LOG_QUEUE_MAX = 10000
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 0.2
+
+# created_at считает сам SQLite (UTC, формат как у datetime.isoformat(timespec="seconds")),
+# то есть это время записи пачки — не позже LOG_FLUSH_INTERVAL после события.
+_SQL_SERVICE_CALL = """
+    INSERT INTO service_call_log
+        (created_at, service, request, response, status_code, duration_ms, error)
+    VALUES (strftime('%Y-%m-%dT%H:%M:%S', 'now'), ?, ?, ?, ?, ?, ?)
+"""
+_SQL_ERROR_LOG = """
+    INSERT INTO error_log (created_at, level, logger, message, user_id, command, details)
+    VALUES (strftime('%Y-%m-%dT%H:%M:%S', 'now'), ?, ?, ?, ?, ?, ?)
+"""
+
+_LOG_QUEUE: "queue.Queue[tuple[str, tuple]]" = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_log_writer_lock = threading.Lock()
+_log_writer: threading.Thread | None = None
+
+
+def _enqueue_log(sql: str, params: tuple) -> None:
+    """
+    Поставить строку журнала в очередь. Если очередь переполнена —
+    выбрасываем самую старую запись, чтобы не расти в памяти без предела.
+    """
+    while True:
+        try:
+            _LOG_QUEUE.put_nowait((sql, params))
+            return
+        except queue.Full:
+            try:
+                _LOG_QUEUE.get_nowait()
+                _LOG_QUEUE.task_done()
+            except queue.Empty:
+                pass
+
+
+def _write_log_batch(batch: list[tuple[str, tuple]]) -> None:
+    """
+    Записать пачку строк журналов одной транзакцией.
+    """
+    by_sql: dict[str, list[tuple]] = {}
+    for sql, params in batch:
+        by_sql.setdefault(sql, []).append(params)
+    try:
+        with _connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for sql, rows in by_sql.items():
+                conn.executemany(sql, rows)
+            conn.commit()
+    except Exception as e:
+        log.error("Не удалось записать %s строк журнала: %s", len(batch), e, exc_info=True)
+
+
+def _log_writer_loop() -> None:
+    while True:
+        batch = [_LOG_QUEUE.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(batch) < LOG_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_LOG_QUEUE.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            _write_log_batch(batch)
+        finally:
+            for _ in batch:
+                _LOG_QUEUE.task_done()
+
+
+def _start_log_writer() -> None:
+    """
+    Запустить фоновый поток записи журналов (один на процесс).
+    """
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is None or not _log_writer.is_alive():
+            _log_writer = threading.Thread(target=_log_writer_loop, name="db-log-writer", daemon=True)
+            _log_writer.start()
+
+
+def flush_logs() -> None:
+    """
+    Дождаться записи всех журналов из очереди (при остановке бота и в тестах).
+    Если фоновый поток не запущен — записываем очередь сами.
+    """
+    if _log_writer is not None and _log_writer.is_alive():
+        _LOG_QUEUE.join()
+        return
+    batch: list[tuple[str, tuple]] = []
+    while True:
+        try:
+            batch.append(_LOG_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        try:
+            _write_log_batch(batch)
+        finally:
+            for _ in batch:
+                _LOG_QUEUE.task_done()
+
+
+atexit.register(flush_logs)
+
 
 def write_service_call(
     service: str,
@@ -454,7 +1228,7 @@ def write_service_call(
     error: Optional[str] = None,
 ) -> None:
     """
-    Записать информацию о вызове внешнего сервиса в service_call_log.
+    Записать информацию о вызове внешнего сервиса в service_call_log (через очередь).
 
     service      — имя сервиса, например 'openrouter'
     request      — строковое представление запроса
@@ -463,29 +1237,17 @@ def write_service_call(
     duration_ms  — длительность вызова в мс
     error        — текст ошибки, если вызов завершился неуспешно
     """
-    try:
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO service_call_log
-                (created_at, service, request, response, status_code, duration_ms, error)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                datetime.utcnow().isoformat(timespec="seconds"),
-                service,
-                request,
-                response,
-                status_code,
-                duration_ms,
-                error,
-            ),
-        )
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        log.error("Не удалось записать запись в service_call_log: %s", e, exc_info=True)
+    _enqueue_log(
+        _SQL_SERVICE_CALL,
+        (
+            service,
+            request,
+            response,
+            status_code,
+            duration_ms,
+            error,
+        ),
+    )
 
 def write_error_log(
     level: str,
@@ -496,35 +1258,24 @@ def write_error_log(
     details: Optional[str] = None,
 ) -> None:
     """
-    Записать одну строку в таблицу error_log.
+    Записать одну строку в таблицу error_log (через очередь).
 
     Используем для важных ошибок:
     - OpenRouterError (401/429/5xx),
     - серьезные ошибки БД,
     - падения хендлеров
     """
-    try:
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO error_log (created_at, level, logger, message, user_id, command, details)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                datetime.utcnow().isoformat(timespec="seconds"),
-                level,
-                logger_name,
-                message,
-                user_id,
-                command,
-                details,
-            ),
-        )
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        log.error("Не удалось записать ошибку в error_log: %s", e, exc_info=True)
+    _enqueue_log(
+        _SQL_ERROR_LOG,
+        (
+            level,
+            logger_name,
+            message,
+            user_id,
+            command,
+            details,
+        ),
+    )
 
 
 def get_setting_or_default(key: str, default: str) -> str:
@@ -532,14 +1283,14 @@ def get_setting_or_default(key: str, default: str) -> str:
     Вернуть динамический параметр по ключу.
     Если параметра нет — вернуть default.
     """
-    with _connect() as conn:
+    with _read(tuples=True) as conn:
         row = conn.execute(
             "SELECT value FROM settings WHERE key = ?",
             (key,),
         ).fetchone()
     if row is None:
         return default
-    return row["value"]
+    return row[0]
 
 
 def get_int_setting(key: str, default: int) -> int:
@@ -571,14 +1322,14 @@ def is_feature_enabled(name: str, default: bool) -> bool:
     Вернуть состояние фиче-тоггла по имени.
     Если записи нет — вернуть default.
     """
-    with _connect() as conn:
+    with _read(tuples=True) as conn:
         row = conn.execute(
             "SELECT enabled FROM feature_toggles WHERE name = ?",
             (name,),
         ).fetchone()
     if row is None:
         return default
-    return bool(row["enabled"])
+    return bool(row[0])
 
 
 def set_setting(key: str, value: str) -> None:
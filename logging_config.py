@@ -14,9 +14,7 @@ import os
 import time
 from logging.handlers import RotatingFileHandler
 
-from dotenv import load_dotenv
-
-load_dotenv()
+import config  # noqa: F401 — .env разбирается один раз, в config.py
 
 
 class DotTimeFormatter(logging.Formatter):
@@ -4,8 +4,9 @@ main.py — точка входа Telegram-бота (pyTelegramBotAPI / TeleBot)
 Команды:
   /start                  — приветствие + список команд
   /note_add <текст>       — добавить заметку
+  /note_import <строки>   — добавить несколько заметок (по одной на строку)
   /note_list [N]          — показать последние N заметок (по умолчанию 10, максимум 50)
-  /note_find <подстрока>  — поиск заметок по тексту (без учёта регистра)
+  /note_find <подстрока>  — поиск заметок по тексту (без учёта регистра; «текст*» — по началу)
   /note_edit <id> <текст> — изменить текст заметки
   /note_del <id>          — удалить заметку
   /note_count             — количество заметок
@@ -28,21 +29,26 @@ main.py — точка входа Telegram-бота (pyTelegramBotAPI / TeleBot)
 
 from __future__ import annotations
 
-import os
+import functools
+import io
 import logging
-from typing import Iterable
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
 
-import random
+import re
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import telebot
 from telebot import types
 
-from config import TOKEN, MAX_PROMPT_CHARS_DEFAULT, SHOW_MODEL_FOOTER_DEFAULT, DEBUG_SETTINGS_SHOW, CMD_MODEL_ID_ENABLED
+from config import TOKEN, BOT_NUM_THREADS, LLM_NUM_THREADS, LLM_MAX_PENDING, MAX_PROMPT_CHARS_DEFAULT, MAX_PROMPT_BYTES_DEFAULT, SHOW_MODEL_FOOTER_DEFAULT, DEBUG_SETTINGS_SHOW, CMD_MODEL_ID_ENABLED, ASK_BATCHING_ENABLED
 import db
 
 from telebot import types
-from openrouter_client import chat_once, OpenRouterError
-from db import (get_active_model, list_models, set_active_model, list_characters, get_user_character, set_user_character, get_character_by_id, write_error_log, get_int_setting, get_bool_setting, is_feature_enabled, set_setting, set_feature_toggle)
+from openrouter_client import chat_once, OpenRouterError, BatchedAsker, prewarm
+from db import (get_active_model, list_models, set_active_model, list_characters, get_user_character, set_user_character, write_error_log, get_int_setting, get_bool_setting, is_feature_enabled, set_setting, set_feature_toggle)
 
 from logging_config import setup_logging
 from metrics import metric, timed
@@ -53,41 +59,37 @@ log = logging.getLogger(__name__)
 
 log.info("Старт приложения (инициализация бота)")
 
-# Создаём объект бота
-bot = telebot.TeleBot(TOKEN)
+# Создаём объект бота. Обработчики выполняются в пуле из BOT_NUM_THREADS потоков,
+# а сами запросы к OpenRouter — в _LLM_POOL: пока /ask ждёт модель, остальные
+# пользователи получают ответы без очереди.
+bot = telebot.TeleBot(TOKEN, num_threads=BOT_NUM_THREADS)
 
 # Инициализируем БД при старте процесса
 db.init_db()
 
+# Общие правила для system-промпта — неизменяемая часть, собирается один раз при импорте
+_SYSTEM_RULES = (
+    "Правила:\n"
+    "1) Всегда держи стиль и манеру речи выбранного персонажа. При необходимости — переформулируй.\n"
+    "2) Технические ответы давай корректно и по пунктам, но в характерной манере.\n"
+    "3) Не раскрывай, что ты 'играешь роль'.\n"
+    "4) Не используй длинные дословные цитаты из фильмов/книг (>10 слов).\n"
+    "5) Если стиль персонажа выражен слабо — переформулируй ответ и усили характер персонажа, сохраняя фактическую точность.\n"
+)
+
 @timed("build_messages_ms", logger=log)
 def _build_messages(user_id: int, user_text: str) -> list[dict]:
-    p = get_user_character(user_id)
-    system = (
-        f"Ты отвечаешь строго в образе персонажа: {p['name']}.\n"
-        f"{p['prompt']}\n"
-        "Правила:\n"
-        "1) Всегда держи стиль и манеру речи выбранного персонажа. При необходимости — переформулируй.\n"
-        "2) Технические ответы давай корректно и по пунктам, но в характерной манере.\n"
-        "3) Не раскрывай, что ты 'играешь роль'.\n"
-        "4) Не используй длинные дословные цитаты из фильмов/книг (>10 слов).\n"
-        "5) Если стиль персонажа выражен слабо — переформулируй ответ и усили характер персонажа, сохраняя фактическую точность.\n"
-    )
-    return [
-        {"role": "system", "content": system},
-        {"role": "user", "content": user_text},
-    ]
+    return _build_messages_for_character(get_user_character(user_id), user_text)
+
+@functools.lru_cache(maxsize=256)
+def _system_prompt(name: str, prompt: str) -> str:
+    """
+    Готовый system-промпт персонажа: персонажей немного, строка собирается один раз на персонажа.
+    """
+    return f"Ты отвечаешь строго в образе персонажа: {name}.\n{prompt}\n{_SYSTEM_RULES}"
 
 def _build_messages_for_character(character: dict, user_text: str) -> list[dict]:
-    system = (
-        f"Ты отвечаешь строго в образе персонажа: {character['name']}.\n"
-        f"{character['prompt']}\n"
-        "Правила:\n"
-        "1) Всегда держи стиль и манеру речи выбранного персонажа. При необходимости — переформулируй.\n"
-        "2) Технические ответы давай корректно и по пунктам, но в характерной манере.\n"
-        "3) Не раскрывай, что ты 'играешь роль'.\n"
-        "4) Не используй длинные дословные цитаты из фильмов/книг (>10 слов).\n"
-        "5) Если стиль персонажа выражен слабо — переформулируй ответ и усили характер персонажа, сохраняя фактическую точность.\n"
-    )
+    system = _system_prompt(character["name"], character["prompt"])
     return [
         {"role": "system", "content": system},
         {"role": "user", "content": user_text},
@@ -97,59 +99,182 @@ def _build_messages_for_character(character: dict, user_text: str) -> list[dict]
 # Вспомогательные функции
 # ---------------------------
 
+# Одновременные /ask и /ask_random к одной модели и одному персонажу уходят одним запросом
+_asker = BatchedAsker()
+
+# Кэш ответов LLM: одинаковый вопрос к той же модели и тому же персонажу (temperature=0.2)
+# отдаём из памяти, без запроса к OpenRouter. LRU на LLM_CACHE_MAX записей.
+LLM_CACHE_MAX = 512
+_llm_cache: OrderedDict[tuple[str, str, str], str] = OrderedDict()
+_llm_cache_lock = threading.Lock()
+# Вопросы, ответ на которые сейчас запрашивается: одинаковые вопросы из разных чатов,
+# пришедшие до ответа, ждут этот же запрос (single-flight), а не шлют свой
+_llm_inflight: dict[tuple[str, str, str], Future] = {}
+
+def _ask_llm(msgs: list[dict], model_key: str) -> tuple[str, int, bool]:
+    """
+    Запрос к LLM: из кэша ответов, через склейку (фиче-тоггл ask_batching) или напрямую.
+    Возвращает (текст, мс, взят_из_кэша); ответ на чужой одновременный запрос — тоже «из кэша».
+    """
+    # Ключ: модель + system-промпт (он однозначно задаёт персонажа) + вопрос без регистра/лишних пробелов
+    key = (model_key, msgs[0]["content"], " ".join(msgs[-1]["content"].lower().split()))
+    with _llm_cache_lock:
+        text = _llm_cache.get(key)
+        if text is not None:
+            _llm_cache.move_to_end(key)
+        else:
+            inflight = _llm_inflight.get(key)
+            owner = inflight is None
+            if owner:
+                inflight = _llm_inflight[key] = Future()
+    if text is not None:
+        metric.counter("llm_cache_hits_total").inc()
+        return text, 0, True
+    if not owner:
+        # Такой же вопрос уже в пути — ждём его ответ (или его же исключение)
+        metric.counter("llm_inflight_joins_total").inc()
+        text, _ = inflight.result()
+        return text, 0, True
+
+    try:
+        if is_feature_enabled("ask_batching", ASK_BATCHING_ENABLED):
+            text, ms = _asker.ask(msgs, model=model_key, temperature=0.2, max_tokens=400)
+        else:
+            text, ms = chat_once(msgs, model=model_key, temperature=0.2, max_tokens=400)
+    except BaseException as e:
+        with _llm_cache_lock:
+            del _llm_inflight[key]
+        inflight.set_exception(e)
+        raise
+    with _llm_cache_lock:
+        if text:
+            _llm_cache[key] = text
+            if len(_llm_cache) > LLM_CACHE_MAX:
+                _llm_cache.popitem(last=False)
+        del _llm_inflight[key]
+    inflight.set_result((text, ms))
+    return text, ms, False
+
 def _fmt_notes(rows: Iterable) -> str:
     """
     Форматирует список заметок для ответа в чат.
     """
     if not rows:
         return "У вас пока нет заметок."
-    # Каждая строка вида: "12: купить хлеб"
-    return "\n".join(f"{r['id']}: {r['text']}" for r in rows)
+    # Каждая строка вида: "12: купить хлеб"; строки — кортежи (id, text, ...).
+    # Список, а не генератор: str.join всё равно материализует его, а по списку сразу знает длину.
+    return "\n".join([f"{r[0]}: {r[1]}" for r in rows])
+
+# "/note_edit <id> <новый текст>"
+_NOTE_EDIT_RE = re.compile(r"^(\d+)\s+(.+)$", re.S)
+# "/set_toggle <имя> <on|off>"
+_SET_TOGGLE_RE = re.compile(r"^(\S+)\s+(\S+)$")
+
+def _cmd_args(text: str | None) -> str:
+    """
+    Аргументы команды без самой команды (и суффикса @имя_бота); "" — если их нет.
+    """
+    # "/команда[@имя_бота] [аргументы]" — аргументы начинаются после первого пробела/перевода строки
+    parts = (text or "").split(None, 1)
+    return parts[1].strip() if len(parts) == 2 else ""
+
+# Статус «печатает…» в Telegram гаснет примерно через 5 секунд — обновляем чуть раньше
+TYPING_REFRESH_S = 4.0
+
+def _send_typing(chat_id: int) -> None:
+    try:
+        bot.send_chat_action(chat_id, "typing")
+    except Exception as e:
+        log.debug("send_chat_action failed: %r", e)
+
+@contextmanager
+def _typing(chat_id: int) -> Iterator[None]:
+    """
+    Показывает «печатает…», пока выполняется блок (долгий запрос к LLM).
+    Пользователь видит, что бот работает, и не шлёт вопрос повторно.
+    """
+    _send_typing(chat_id)
+    done = threading.Event()
+
+    def _refresh() -> None:
+        while not done.wait(TYPING_REFRESH_S):
+            _send_typing(chat_id)
+
+    threading.Thread(target=_refresh, name="typing", daemon=True).start()
+    try:
+        yield
+    finally:
+        done.set()
+
+def _clip_bytes(s: str, max_bytes: int) -> str:
+    """
+    Обрезает строку до max_bytes байт в UTF-8, не разрывая многобайтовый символ.
+    """
+    b = s.encode("utf-8")
+    return s if len(b) <= max_bytes else b[:max_bytes].decode("utf-8", errors="ignore")
+
+def _clip_question(q: str) -> str:
+    """
+    Вопрос к LLM: не длиннее max_prompt_chars символов и max_prompt_bytes байт.
+    Байтовый лимит предсказуем для любого языка (кириллица — 2 байта на символ).
+    """
+    max_len = get_int_setting("max_prompt_chars", MAX_PROMPT_CHARS_DEFAULT)
+    max_bytes = get_int_setting("max_prompt_bytes", MAX_PROMPT_BYTES_DEFAULT)
+    return _clip_bytes(q[:max_len], max_bytes)
 
 def _parse_int(token: str) -> int | None:
     """
     Пытается распарсить целое число из строки (например, id или лимит).
+    Без try/except: опечатки пользователей — частый случай, исключение тут лишнее.
     """
-    try:
-        return int(token.strip())
-    except Exception:
-        return None
+    token = token.strip()
+    return int(token) if token.isascii() and token.isdigit() else None
+
+# Готовые полоски длиной 0..30 — собираются один раз при импорте
+_BARS = tuple("·" * i for i in range(31))
 
 def _bar(n: int) -> str:
     """
     ASCII-«полоска» для гистограммы. Ограничим до 30 символов,
     чтобы не растягивать сообщение.
     """
-    n = max(0, min(int(n or 0), 30))
-    return "·" * n
+    return _BARS[max(0, min(int(n or 0), 30))]
+
+# Меню команд — собирается один раз при импорте
+_BOT_COMMANDS = tuple(types.BotCommand(name, description) for name, description in (
+    ("start", "Приветствие и помощь"),
+    ("note_add", "Добавить заметку"),
+    ("note_import", "Добавить несколько заметок"),
+    ("note_list", "Список заметок"),
+    ("note_find", "Поиск заметок"),
+    ("note_edit", "Изменить заметку"),
+    ("note_del", "Удалить заметку"),
+    ("note_count", "Сколько заметок"),
+    ("note_export", "Экспорт заметок в .txt"),
+    ("note_stats", "Статистика по датам"),
+    ("model", "Установить активную модель"),
+    ("models", "Получить список моделей"),
+    ("ask", "Задать вопрос модели"),
+    ("ask_random", "Задать вопрос случайной модели"),
+    ("character", "Установить активного персонажа"),
+    ("characters", "Получить список персонажей"),
+    ("whoami", "Получить активную модель и активного персонажа"),
+    ("stats", "Мониторинг бота"),
+))
+_DEBUG_SETTINGS_COMMAND = types.BotCommand("debug_settings", "Показать настройки бота")
 
 def _setup_bot_commands() -> None:
     """
     Регистрирует команды в меню клиента Telegram (удобно для новичков).
+    Вызывается в фоновом потоке, поэтому ошибки только логируем.
     """
-    cmds = [
-        types.BotCommand("start", "Приветствие и помощь"),
-        types.BotCommand("note_add", "Добавить заметку"),
-        types.BotCommand("note_list", "Список заметок"),
-        types.BotCommand("note_find", "Поиск заметок"),
-        types.BotCommand("note_edit", "Изменить заметку"),
-        types.BotCommand("note_del", "Удалить заметку"),
-        types.BotCommand("note_count", "Сколько заметок"),
-        types.BotCommand("note_export", "Экспорт заметок в .txt"),
-        types.BotCommand("note_stats", "Статистика по датам"),
-        types.BotCommand("model", "Установить активную модель"),
-        types.BotCommand("models", "Получить список моделей"),
-        types.BotCommand("ask", "Задать вопрос модели"),
-        types.BotCommand("ask_random", "Задать вопрос случайной модели"),
-        types.BotCommand("character", "Установить активного персонажа"),
-        types.BotCommand("characters", "Получить список персонажей"),
-        types.BotCommand("whoami", "Получить активную модель и активного персонажа"),
-        types.BotCommand("stats", "Мониторинг бота"),
-    ]
+    cmds = list(_BOT_COMMANDS)
     if is_feature_enabled("debug_settings", DEBUG_SETTINGS_SHOW):
-        cmds.append(types.BotCommand("debug_settings", "Показать настройки бота"))
-
-    bot.set_my_commands(cmds)
+        cmds.append(_DEBUG_SETTINGS_COMMAND)
+    try:
+        bot.set_my_commands(cmds)
+    except Exception:
+        log.exception("Не удалось зарегистрировать меню команд")
 # Паттерн set_my_commands — см. Л2 (удобное меню команд в клиенте).  [oai_citation:17‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq)
 
 
@@ -157,48 +282,47 @@ def _setup_bot_commands() -> None:
 # Обработчики команд
 # ---------------------------
 
-@bot.message_handler(commands=["start", "help"])
+# Текст /start и /help — статичный, собирается один раз при импорте
+_HELP_TEXT = (
+    "Привет! Это заметочник на SQLite.\n\n"
+    "Команды:\n"
+    "  /note_add <текст>\n"
+    "  /note_import <строки>\n"
+    "  /note_list [N]\n"
+    "  /note_find <подстрока>\n"
+    "  /note_edit <id> <текст>\n"
+    "  /note_del <id>\n"
+    "  /note_count\n"
+    "  /note_export\n"
+    "  /note_stats [days]\n"
+    "  /models \n"
+    "  /model <id>\n"
+    "  /ask <вопрос>\n"
+    "  /ask_random <вопрос>\n"
+    "  /characters \n"
+    "  /character <id>\n"
+    "  /whoami \n"
+)
+
 def cmd_start(message: types.Message) -> None:
     """
     Поприветствовать пользователя и кратко описать команды.
     """
     log.debug("Запущена команда /start")
-    text = (
-        "Привет! Это заметочник на SQLite.\n\n"
-        "Команды:\n"
-        "  /note_add <текст>\n"
-        "  /note_list [N]\n"
-        "  /note_find <подстрока>\n"
-        "  /note_edit <id> <текст>\n"
-        "  /note_del <id>\n"
-        "  /note_count\n"
-        "  /note_export\n"
-        "  /note_stats [days]\n"
-        "  /models \n"
-        "  /model <id>\n"
-        "  /ask <вопрос>\n"
-        "  /ask_random <вопрос>\n"
-        "  /characters \n"
-        "  /character <id>\n"
-        "  /whoami \n"
-    )
-    log.debug(f"Команда start вернула текст:\n{text}")
-    bot.reply_to(message, text)
+    log.debug("Команда start вернула текст:\n%s", _HELP_TEXT)
+    bot.reply_to(message, _HELP_TEXT)
 
 
-@bot.message_handler(commands=["note_add"])
 def cmd_note_add(message: types.Message) -> None:
     """
     Добавить новую заметку: /note_add купить хлеб
     """
-    metric.counter("commands_total").inc()
-    metric.counter("note_add_requests_total").inc()
-    parts = message.text.split(maxsplit=1)
-    if len(parts) < 2 or not parts[1].strip():
+    metric.inc_many("commands_total", "note_add_requests_total")
+    text = _cmd_args(message.text)
+    if not text:
         bot.reply_to(message, "Формат: /note_add <текст заметки>")
         return
 
-    text = parts[1].strip()
     note_id = db.add_note(message.from_user.id, text)
     if note_id is None:
         # Либо пусто, либо UNIQUE-конфликт (такая заметка уже есть)
@@ -207,56 +331,64 @@ def cmd_note_add(message: types.Message) -> None:
         bot.reply_to(message, f"Заметка #{note_id} добавлена.")
 
 
-@bot.message_handler(commands=["note_list"])
+def cmd_note_import(message: types.Message) -> None:
+    """
+    Добавить несколько заметок сразу — по одной на строку:
+    /note_import
+    купить хлеб
+    позвонить маме
+    """
+    metric.inc_many("commands_total", "note_import_requests_total")
+    payload = _cmd_args(message.text)
+    if not payload:
+        bot.reply_to(message, "Формат: /note_import, затем заметки — по одной на строку")
+        return
+
+    added = db.add_notes_bulk(message.from_user.id, payload.splitlines())
+    bot.reply_to(message, f"Добавлено заметок: {added}.")
+
+
 def cmd_note_list(message: types.Message) -> None:
     """
     Показать последние N заметок: /note_list [N]
     """
     # Опциональный аргумент лимита
-    metric.counter("commands_total").inc()
-    metric.counter("note_list_requests_total").inc()
-    parts = message.text.split(maxsplit=1)
-    limit = _parse_int(parts[1]) if len(parts) == 2 else 10
+    metric.inc_many("commands_total", "note_list_requests_total")
+    arg = _cmd_args(message.text)
+    limit = _parse_int(arg) if arg else 10
 
     rows = db.list_notes(message.from_user.id, limit=limit or 10)
     bot.reply_to(message, _fmt_notes(rows))
 
 
-@bot.message_handler(commands=["note_find"])
 def cmd_note_find(message: types.Message) -> None:
     """
     Поиск заметок по подстроке: /note_find хлеб
+    Поиск по началу заметки: /note_find купить*
     """
-    metric.counter("commands_total").inc()
-    metric.counter("note_find_requests_total").inc()
-    parts = message.text.split(maxsplit=1)
-    if len(parts) < 2 or not parts[1].strip():
+    metric.inc_many("commands_total", "note_find_requests_total")
+    needle = _cmd_args(message.text)
+    if not needle:
         bot.reply_to(message, "Формат: /note_find <подстрока>")
         return
 
-    needle = parts[1].strip()
-    rows = db.search_notes(message.from_user.id, needle, limit=10)
+    prefix = needle.endswith("*") and len(needle) > 1
+    if prefix:
+        needle = needle[:-1]
+    rows = db.search_notes(message.from_user.id, needle, limit=10, prefix=prefix)
     if not rows:
         bot.reply_to(message, "Ничего не найдено.")
     else:
-        bot.reply_to(message, "\n".join(f"{r['id']}: {r['text']}" for r in rows))
+        bot.reply_to(message, _fmt_notes(rows))
 
 
-@bot.message_handler(commands=["note_edit"])
 def cmd_note_edit(message: types.Message) -> None:
     """
     Изменить текст заметки: /note_edit 12 купить молоко
     """
-    metric.counter("commands_total").inc()
-    metric.counter("note_edit_requests_total").inc()
-    parts = message.text.split(maxsplit=2)
-    if len(parts) < 3:
-        bot.reply_to(message, "Формат: /note_edit <id> <новый текст>")
-        return
-
-    note_id = _parse_int(parts[1])
-    new_text = parts[2].strip() if len(parts) >= 3 else ""
-    if not note_id or not new_text:
+    metric.inc_many("commands_total", "note_edit_requests_total")
+    m = _NOTE_EDIT_RE.match(_cmd_args(message.text))
+    if not m or not (note_id := int(m.group(1))) or not (new_text := m.group(2).strip()):
         bot.reply_to(message, "Формат: /note_edit <id> <новый текст>")
         return
 
@@ -264,15 +396,12 @@ def cmd_note_edit(message: types.Message) -> None:
     bot.reply_to(message, "Готово." if ok else "Не найдено (проверьте id).")
 
 
-@bot.message_handler(commands=["note_del"])
 def cmd_note_del(message: types.Message) -> None:
     """
     Удалить заметку: /note_del 12
     """
-    metric.counter("commands_total").inc()
-    metric.counter("note_del_requests_total").inc()
-    parts = message.text.split(maxsplit=1)
-    note_id = _parse_int(parts[1]) if len(parts) == 2 else None
+    metric.inc_many("commands_total", "note_del_requests_total")
+    note_id = _parse_int(_cmd_args(message.text))
     if not note_id:
         bot.reply_to(message, "Формат: /note_del <id>")
         return
@@ -281,57 +410,41 @@ def cmd_note_del(message: types.Message) -> None:
     bot.reply_to(message, "Удалено." if ok else "Не найдено (проверьте id).")
 
 
-@bot.message_handler(commands=["note_count"])
 def cmd_note_count(message: types.Message) -> None:
     """
     Количество заметок пользователя.
     """
-    metric.counter("commands_total").inc()
-    metric.counter("note_count_requests_total").inc()
+    metric.inc_many("commands_total", "note_count_requests_total")
     total = db.count_notes(message.from_user.id)
     bot.reply_to(message, f"У вас {total} заметок.")
 
 
-@bot.message_handler(commands=["note_export"])
 def cmd_note_export(message: types.Message) -> None:
     """
     Экспорт заметок пользователя в текстовый файл и отправка как документ.
     """
-    metric.counter("commands_total").inc()
-    metric.counter("note_export_requests_total").inc()
-    rows = db.list_notes(message.from_user.id, limit=1000)
+    metric.inc_many("commands_total", "note_export_requests_total")
+    user_id = message.from_user.id
+    rows = db.export_notes(user_id, limit=1000)
     if not rows:
         bot.reply_to(message, "Экспортировать нечего — заметок нет.")
         return
 
-    fname = f"notes_{message.from_user.id}.txt"
-    # Простая TSV-выгрузка: <id>\t<text>
-    with open(fname, "w", encoding="utf-8") as f:
-        for r in rows:
-            f.write(f"{r['id']}\t{r['text']}\n")
-
-    # Отправляем файл и стараемся удалить после
-    try:
-        with open(fname, "rb") as f:
-            bot.send_document(message.chat.id, f)
-    finally:
-        try:
-            os.remove(fname)
-        except OSError:
-            pass
+    fname = f"notes_{user_id}.txt"
+    # Простая TSV-выгрузка: <id>\t<text> — собираем в памяти, без временного файла на диске
+    data = "".join([f"{r[0]}\t{r[1]}\n" for r in rows]).encode("utf-8")
+    bot.send_document(message.chat.id, io.BytesIO(data), visible_file_name=fname)
 # Экспорт как в примере Л3 — «вау-эффект»: бот присылает файл пользователю.
 
 
-@bot.message_handler(commands=["note_stats"])
 def cmd_note_stats(message: types.Message) -> None:
     """
     ASCII-гистограмма: сколько заметок по дням.
     Пример: /note_stats 7
     """
-    metric.counter("commands_total").inc()
-    metric.counter("note_stats_requests_total").inc()
-    parts = message.text.split(maxsplit=1)
-    days = _parse_int(parts[1]) if len(parts) == 2 else 7
+    metric.inc_many("commands_total", "note_stats_requests_total")
+    arg = _cmd_args(message.text)
+    days = _parse_int(arg) if arg else 7
     days = days if (days and days > 0) else 7
 
     rows = db.stats_by_date(message.from_user.id, days=days)
@@ -339,29 +452,26 @@ def cmd_note_stats(message: types.Message) -> None:
         bot.reply_to(message, "Данных пока нет.")
         return
 
-    lines = [f"{r['d']}: {_bar(r['total'])} {r['total']}" for r in rows]
-    bot.reply_to(message, "Последние дни:\n" + "\n".join(lines))
+    bot.reply_to(message, "Последние дни:\n" + "\n".join(
+        f"{d}: {_bar(total)} {total}" for d, total in rows
+    ))
 # Группировка/визуализация — приём из Л3 (GROUP BY + ASCII-гистограмма).
 
-@bot.message_handler(commands=["models"])
 def cmd_models(message: types.Message) -> None:
     """
     Показать список LLM моделей
     """
-    metric.counter("commands_total").inc()
-    metric.counter("models_requests_total").inc()
+    metric.inc_many("commands_total", "models_requests_total")
     items = list_models()
     if not items:
         bot.reply_to(message, "Список моделей пуст.")
         return
-    lines = ["Доступные модели:"]
-    for m in items:
-        star = "★" if m["active"] else " "
-        lines.append(f"{star} {m['id']}. {m['label']}  [{m['key']}]")
-    lines.append("\nАктивировать: /model <ID>")
-    bot.reply_to(message, "\n".join(lines))
-
-@bot.message_handler(commands=["model"])
+    bot.reply_to(message, "\n".join([
+        "Доступные модели:",
+        *[f"{'★' if m['active'] else ' '} {m['id']}. {m['label']}  [{m['key']}]" for m in items],
+        "\nАктивировать: /model <ID>",
+    ]))
+
 def cmd_model(message: types.Message) -> None:
     """
     Установить активной LLM модель
@@ -370,9 +480,8 @@ def cmd_model(message: types.Message) -> None:
         bot.reply_to(message, "Команды выбора модели временно отключены.")
         return
 
-    metric.counter("commands_total").inc()
-    metric.counter("model_requests_total").inc()
-    arg = message.text.replace("/model", "", 1).strip()
+    metric.inc_many("commands_total", "model_requests_total")
+    arg = _cmd_args(message.text)
     if not arg:
         active = get_active_model()
         bot.reply_to(message, f"Текущая активная модель: {active['label']} [{active['key']}]\n(сменить: /model <ID> или /models)")
@@ -382,109 +491,169 @@ def cmd_model(message: types.Message) -> None:
         return
     try:
         active = set_active_model(int(arg))
+        # Ответы прежней модели больше не понадобятся (ключ кэша включает модель)
+        with _llm_cache_lock:
+            _llm_cache.clear()
         bot.reply_to(message, f"Активная модель переключена: {active['label']} [{active['key']}]")
     except ValueError:
         bot.reply_to(message, "Неизвестный ID модели. Сначала /models.")
 
-@bot.message_handler(commands=["ask"])
-def cmd_ask(message: types.Message) -> None:
+# Запросы к OpenRouter идут сетью секундами — держим их в своём пуле, а поток TeleBot
+# сразу освобождается под следующий апдейт (GIL на сетевом ожидании отпускается).
+_LLM_POOL = ThreadPoolExecutor(max_workers=LLM_NUM_THREADS, thread_name_prefix="llm")
+
+# Очереди вопросов по чатам: в каждом чате одновременно не больше одного запроса к LLM —
+# ответы приходят в порядке вопросов, а один чат, засыпавший бота /ask, занимает
+# лишь один поток _LLM_POOL, не задерживая остальные чаты.
+_chat_queues: dict[int, deque] = {}
+_chat_queues_lock = threading.Lock()
+# Принятые, но ещё не выполненные вопросы по всем чатам (не больше LLM_MAX_PENDING)
+_llm_pending = 0
+
+def _run_chat_queue(chat_id: int, fut: Future, task: Callable[[], None]) -> None:
+    """
+    Выполняет задачи одного чата по очереди, пока очередь не опустеет.
+    """
+    global _llm_pending
+    while True:
+        if fut.set_running_or_notify_cancel():
+            try:
+                task()
+            except BaseException as e:
+                # Исключения из пула сами не всплывают — логируем, чтобы не потерять
+                log.error("Ошибка в фоновом запросе к LLM", exc_info=e)
+                fut.set_exception(e)
+            else:
+                fut.set_result(None)
+        with _chat_queues_lock:
+            _llm_pending -= 1
+            queue = _chat_queues[chat_id]
+            if not queue:
+                del _chat_queues[chat_id]
+                return
+            fut, task = queue.popleft()
+
+def _ask_and_reply(message: types.Message, msgs: list[dict], model_key: str, *,
+                   command: str, suffix: str = "", footer: bool = True) -> Future:
+    """
+    Общая часть /ask и /ask_random: ставит запрос в очередь чата, ответ придёт из _do_ask
+    (в потоке _LLM_POOL).
+    """
+    global _llm_pending
+    chat_id = message.chat.id
+    fut: Future = Future()
+    task = functools.partial(_do_ask, message, msgs, model_key,
+                             command=command, suffix=suffix, footer=footer)
+    with _chat_queues_lock:
+        busy = _llm_pending >= LLM_MAX_PENDING
+        if not busy:
+            _llm_pending += 1
+            queue = _chat_queues.get(chat_id)
+            if queue is not None:
+                # В чате уже идёт запрос — его поток возьмёт этот следующим
+                queue.append((fut, task))
+                return fut
+            _chat_queues[chat_id] = deque()
+    if busy:
+        metric.counter("llm_rejected_total").inc()
+        bot.reply_to(message, "Бот сейчас перегружен, повторите вопрос через минуту.")
+        fut.set_result(None)
+        return fut
+    _LLM_POOL.submit(_run_chat_queue, chat_id, fut, task)
+    return fut
+
+def _report_error(message: types.Message, command: str, error_text: str, reply: str) -> None:
+    """
+    Записать ошибку команды в error_log и ответить пользователю.
+    """
+    write_error_log(
+        level="ERROR",
+        logger_name=__name__,
+        message=error_text,
+        user_id=message.from_user.id,
+        command=command,
+        details=None,
+    )
+    bot.reply_to(message, reply)
+
+def _do_ask(message: types.Message, msgs: list[dict], model_key: str, *,
+            command: str, suffix: str, footer: bool) -> None:
     """
-    Задать вопрос LLM модели
+    Запрос к LLM, обработка ошибок, ответ в чат (выполняется в _LLM_POOL).
+    suffix дописывается в подвал ответа (например, имя персонажа).
     """
-    metric.counter("commands_total").inc()
-    metric.counter("ask_requests_total").inc()
-
     user_id = message.from_user.id
-    q = message.text.replace("/ask", "", 1).strip()
-    if not q:
-        bot.reply_to(message, "Использование: /ask <вопрос>")
-        return
-
-    max_len = get_int_setting("max_prompt_chars", MAX_PROMPT_CHARS_DEFAULT)
-
-    msgs = _build_messages(user_id, q[:max_len])
-    model_key = get_active_model()["key"]
-
-    log.info("Команда /ask от user_id=%s, вопрос=%.80s", user_id, q)
-
     try:
-        text, ms = chat_once(msgs, model=model_key, temperature=0.2, max_tokens=400)
+        with _typing(message.chat.id):
+            text, ms, cached = _ask_llm(msgs, model_key)
 
     except OpenRouterError as e:
         metric.counter("openrouter_errors_total").inc()
 
-        log.error("OpenRouterError при /ask от user_id=%s: %s", user_id, e)
-        write_error_log(
-            level="ERROR",
-            logger_name=__name__,
-            message=str(e),
-            user_id=user_id,
-            command="/ask",
-            details=None,
-        )
-        bot.reply_to(message, f"Ошибка: {e}")
+        log.error("OpenRouterError при %s от user_id=%s: %s", command, user_id, e)
+        _report_error(message, command, str(e), f"Ошибка: {e}")
         return
     except Exception as e:
-        log.exception("Непредвиденная ошибка при /ask от user_id=%s", user_id)
-        write_error_log(
-            level="ERROR",
-            logger_name=__name__,
-            message=f"Unhandled error in /ask: {e}",
-            user_id=user_id,
-            command="/ask",
-            details=None,
-        )
-        bot.reply_to(message, "Непредвиденная ошибка.")
+        log.exception("Непредвиденная ошибка при %s от user_id=%s", command, user_id)
+        _report_error(message, command, f"Unhandled error in {command}: {e}", "Непредвиденная ошибка.")
         return
 
-    metric.latency("openrouter_latency_ms").observe(ms)
+    if not cached:
+        metric.latency("openrouter_latency_ms").observe(ms)
 
     out = (text or "").strip()[:4000]  # не переполняем сообщение Telegram
 
-    show_footer = get_bool_setting("show_model_footer", SHOW_MODEL_FOOTER_DEFAULT)
-    add_info = f"\n\n({ms} мс; модель: {model_key})" if show_footer else ""
+    took = "из кэша" if cached else f"{ms} мс"
+    add_info = f"\n\n({took}; модель: {model_key}{suffix})" if footer else ""
     bot.reply_to(message, f"{out}{add_info}")
 
-@bot.message_handler(commands=["ask_random"])
+def cmd_ask(message: types.Message) -> None:
+    """
+    Задать вопрос LLM модели
+    """
+    metric.inc_many("commands_total", "ask_requests_total")
+
+    user_id = message.from_user.id
+    q = _cmd_args(message.text)
+    if not q:
+        bot.reply_to(message, "Использование: /ask <вопрос>")
+        return
+
+    msgs = _build_messages(user_id, _clip_question(q))
+    model_key = get_active_model()["key"]
+
+    log.info("Команда /ask от user_id=%s, вопрос=%.80s", user_id, q)
+
+    show_footer = get_bool_setting("show_model_footer", SHOW_MODEL_FOOTER_DEFAULT)
+    _ask_and_reply(message, msgs, model_key, command="/ask", footer=show_footer)
+
 def cmd_ask_random(message: types.Message) -> None:
     """
     Задать вопрос случайной LLM модели
     """
-    metric.counter("commands_total").inc()
-    metric.counter("ask_random_requests_total").inc()
-    q = message.text.replace("/ask_random", "", 1).strip()
+    metric.inc_many("commands_total", "ask_random_requests_total")
+    q = _cmd_args(message.text)
     if not q:
         bot.reply_to(message, "Использование: /ask_random <вопрос>")
         return
-    q = q[:600]
+    q = _clip_question(q)
 
-    # Берём случайного персонажа из таблицы (НЕ сохраняем в user_character)
-    items = list_characters()
-    if not items:
+    # Берём случайного персонажа из каталога (НЕ сохраняем в user_character)
+    character = db.get_random_character()
+    if not character:
         bot.reply_to(message, "Каталог персонажей пуст.")
         return
-    chosen = random.choice(items)
-    character = get_character_by_id(chosen["id"])  # получаем prompt
 
     msgs = _build_messages_for_character(character, q)
     model_key = get_active_model()["key"]
 
-    try:
-        text, ms = chat_once(msgs, model=model_key, temperature=0.2, max_tokens=400)
-        out = (text or "").strip()[:4000]
-        bot.reply_to(message, f"{out}\n\n({ms} мс; модель: {model_key}; как: {character['name']})")
-    except OpenRouterError as e:
-        bot.reply_to(message, f"Ошибка: {e}")
-    except Exception:
-        bot.reply_to(message, "Непредвиденная ошибка.")
+    _ask_and_reply(message, msgs, model_key, command="/ask_random", suffix=f"; как: {character['name']}")
 
-@bot.message_handler(commands=["characters"])
 def cmd_characters(message: types.Message) -> None:
     """
     Показать список персонажей
     """
-    metric.counter("commands_total").inc()
-    metric.counter("characters_requests_total").inc()
+    metric.inc_many("commands_total", "characters_requests_total")
     user_id = message.from_user.id
     items = list_characters()
     if not items:
@@ -497,22 +666,19 @@ def cmd_characters(message: types.Message) -> None:
     except Exception:
         current = None
 
-    lines = ["Доступные персонажи:"]
-    for p in items:
-        star = "★" if current is not None and p["id"] == current else " "
-        lines.append(f"{star} {p['id']}. {p['name']}")
-    lines.append("\nВыбор: /character <ID>")
-    bot.reply_to(message, "\n".join(lines))
+    bot.reply_to(message, "\n".join([
+        "Доступные персонажи:",
+        *[f"{'★' if p['id'] == current else ' '} {p['id']}. {p['name']}" for p in items],
+        "\nВыбор: /character <ID>",
+    ]))
 
-@bot.message_handler(commands=["character"])
 def cmd_character(message: types.Message) -> None:
     """
     Установить активным персонажа
     """
-    metric.counter("commands_total").inc()
-    metric.counter("character_requests_total").inc()
+    metric.inc_many("commands_total", "character_requests_total")
     user_id = message.from_user.id
-    arg = message.text.replace("/character", "", 1).strip()
+    arg = _cmd_args(message.text)
     if not arg:
         p = get_user_character(user_id)
         bot.reply_to(message, f"Текущий персонаж: {p['name']}\n(сменить: /characters, затем /character <ID>)")
@@ -526,18 +692,14 @@ def cmd_character(message: types.Message) -> None:
     except ValueError:
         bot.reply_to(message, "Неизвестный ID персонажа. Сначала /characters.")
 
-@bot.message_handler(commands=["whoami"])
 def cmd_whoami(message: types.Message) -> None:
     """
     Показать активную модель и активного персонажа
     """
-    metric.counter("commands_total").inc()
-    metric.counter("whoami_requests_total").inc()
-    character = get_user_character(message.from_user.id)
-    model = get_active_model()
+    metric.inc_many("commands_total", "whoami_requests_total")
+    character, model = db.get_whoami(message.from_user.id)
     bot.reply_to(message, f"Модель: {model['label']} [{model['key']}]\nПерсонаж: {character['name']}")
 
-@bot.message_handler(commands=["stats"])
 def handle_stats(message: types.Message) -> None:
     """
     Показать все накопленные метрики:
@@ -552,51 +714,42 @@ def handle_stats(message: types.Message) -> None:
     counters = stats["counters"]
     latencies = stats["latencies"]
 
-    lines: list[str] = []
-    lines.append("Статистика бота\n")
-
-    # Счетчики
-    lines.append("Счетчики:")
-    if counters:
-        for name, value in sorted(counters.items()):
-            lines.append(f"- {name}: {value}")
-    else:
-        lines.append("- нет данных")
-
-    # Замеры времени
-    lines.append("\nЗамеры времени (мс):")
-    if latencies:
-        for name, data in sorted(latencies.items()):
-            lines.append(
-                f"- {name}: count={data['count']}, "
-                f"avg={data['avg_ms']:.0f}, "
-                f"min={data['min_ms']}, max={data['max_ms']}"
-            )
-    else:
-        lines.append("- нет данных")
-
-    bot.reply_to(message, "\n".join(lines))
+    # Один список и один join: заголовки, счетчики, замеры (по имени — порядок стабилен)
+    no_data = ["- нет данных"]
+    bot.reply_to(message, "\n".join([
+        "Статистика бота\n",
+        "Счетчики:",
+        *([f"- {name}: {value}" for name, value in sorted(counters.items())] or no_data),
+        "\nЗамеры времени (мс):",
+        *([
+            f"- {name}: count={data['count']}, avg={data['avg_ms']:.0f}, "
+            f"min={data['min_ms']}, max={data['max_ms']}"
+            for name, data in sorted(latencies.items())
+        ] or no_data),
+    ]))
 
 
-@bot.message_handler(commands=["debug_settings"])
 def cmd_debug_settings(message):
     """
     Показывает настройки, если фиче-тоггл debug_settings включен.
     Иначе сообщает, что команда отключена.
     """
     max_len = get_int_setting("max_prompt_chars", MAX_PROMPT_CHARS_DEFAULT)
+    max_bytes = get_int_setting("max_prompt_bytes", MAX_PROMPT_BYTES_DEFAULT)
     show_footer = get_bool_setting("show_model_footer", SHOW_MODEL_FOOTER_DEFAULT)
     model_cmds = is_feature_enabled("cmd_model_id", CMD_MODEL_ID_ENABLED)
+    ask_batching = is_feature_enabled("ask_batching", ASK_BATCHING_ENABLED)
 
     text = (
         f"max_prompt_chars = {max_len}\n"
+        f"max_prompt_bytes = {max_bytes}\n"
         f"show_model_footer = {show_footer}\n"
         f"feature: cmd_model_id = {model_cmds}\n"
+        f"feature: ask_batching = {ask_batching}\n"
     )
     bot.reply_to(message, text)
 
 
-@bot.message_handler(commands=["set_setting"])
 def cmd_set_setting(message: types.Message) -> None:
     """
     Админ-команда: установить динамический параметр в таблице settings.
@@ -609,12 +762,12 @@ def cmd_set_setting(message: types.Message) -> None:
       /set_setting show_model_footer=false
     """
 
-    parts = message.text.split(maxsplit=1)
-    if len(parts) < 2 or "=" not in parts[1]:
+    arg = _cmd_args(message.text)
+    if "=" not in arg:
         bot.reply_to(message, "Использование: /set_setting ключ=значение")
         return
 
-    key, value = parts[1].split("=", 1)
+    key, value = arg.split("=", 1)
     key = key.strip()
     value = value.strip()
 
@@ -626,7 +779,6 @@ def cmd_set_setting(message: types.Message) -> None:
     bot.reply_to(message, f"Параметр {key} установлен в {value}")
 
 
-@bot.message_handler(commands=["set_toggle"])
 def cmd_set_toggle(message: types.Message) -> None:
     """
     Админ-команда: включить/выключить фиче-тоггл в таблице feature_toggles.
@@ -639,13 +791,13 @@ def cmd_set_toggle(message: types.Message) -> None:
       /set_toggle cmd_model_id off
     """
 
-    parts = message.text.split(maxsplit=2)
-    if len(parts) < 3:
+    m = _SET_TOGGLE_RE.match(_cmd_args(message.text))
+    if not m:
         bot.reply_to(message, "Использование: /set_toggle имя on|off")
         return
 
-    name = parts[1].strip()
-    state = parts[2].strip().lower()
+    name = m.group(1)
+    state = m.group(2).lower()
 
     if state not in ("on", "off"):
         bot.reply_to(message, "Второй аргумент должен быть on или off.")
@@ -657,11 +809,63 @@ def cmd_set_toggle(message: types.Message) -> None:
 
 
 
+# ---------------------------
+# Маршрутизация команд
+# ---------------------------
+
+# Имя команды (без "/" и @имя_бота) -> обработчик. Вместо 21 фильтра commands=[...],
+# каждый из которых заново разбирает message.text, — один разбор и один поиск в dict.
+_HANDLERS = {
+    "start": cmd_start,
+    "help": cmd_start,
+    "note_add": cmd_note_add,
+    "note_import": cmd_note_import,
+    "note_list": cmd_note_list,
+    "note_find": cmd_note_find,
+    "note_edit": cmd_note_edit,
+    "note_del": cmd_note_del,
+    "note_count": cmd_note_count,
+    "note_export": cmd_note_export,
+    "note_stats": cmd_note_stats,
+    "models": cmd_models,
+    "model": cmd_model,
+    "ask": cmd_ask,
+    "ask_random": cmd_ask_random,
+    "characters": cmd_characters,
+    "character": cmd_character,
+    "whoami": cmd_whoami,
+    "stats": handle_stats,
+    "debug_settings": cmd_debug_settings,
+    "set_setting": cmd_set_setting,
+    "set_toggle": cmd_set_toggle,
+}
+
+def _command_name(text: str | None) -> str | None:
+    """
+    Имя команды из "/команда[@имя_бота] ..." или None, если это не команда.
+    """
+    if not text or text[0] != "/":
+        return None
+    return text.split(None, 1)[0][1:].partition("@")[0]
+
+@bot.message_handler(content_types=["text"])
+def _dispatch(message: types.Message) -> None:
+    """
+    Единственный обработчик текстовых сообщений: отдаёт команду её обработчику.
+    """
+    handler = _HANDLERS.get(_command_name(message.text))
+    if handler is not None:
+        handler(message)
+
+
 # ---------------------------
 # Запуск long polling
 # ---------------------------
 
 if __name__ == "__main__":
-    _setup_bot_commands()  # удобное меню команд в Telegram-клиенте (Л2)
+    # Меню команд (Л2) регистрируем в фоне: запрос setMyCommands идёт параллельно с первым getUpdates
+    threading.Thread(target=_setup_bot_commands, name="set-commands", daemon=True).start()
+    # Соединение с OpenRouter открываем заранее, пока пользователи ещё не спрашивают
+    threading.Thread(target=prewarm, name="openrouter-prewarm", daemon=True).start()
     log.info("Starting bot polling...")
     bot.infinity_polling(skip_pending=True)
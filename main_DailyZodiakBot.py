@@ -13,10 +13,12 @@ main.py — DailyZodiakBot (развлекательный контент без
 
 Рассылка:
   - фоновый поток проверяет раз в минуту: кому отправить сейчас;
-  - условие: subscribed=1, notify_hour == now.hour, last_sent_date != today.
+  - условие: subscribed=1, notify_hour == now.hour, last_sent_date != today;
+  - пользователи «забираются» атомарно (db.claim_due_users), без повторной отправки.
 """
 
 from __future__ import annotations
+import functools
 import logging
 import threading
 import time
@@ -49,12 +51,15 @@ SIGN_ALIASES = {
     "libra":"весы", "scorpio":"скорпион", "sagittarius":"стрелец", "capricorn":"козерог", "aquarius":"водолей", "pisces":"рыбы"
 }
 
+# Любое допустимое написание -> канон: один поиск в dict вместо обхода списка и второго словаря
+_SIGN_LOOKUP = {**{s: s for s in CANON_SIGNS}, **SIGN_ALIASES}
+# Фильтр кнопок проверяет каждое входящее сообщение — множество вместо списка
+_CANON_SET = frozenset(CANON_SIGNS)
+
 def normalize_sign(text: str) -> str | None:
     t = (text or "").strip().lower()
     t = t.replace("ё", "е")
-    if t in CANON_SIGNS:
-        return t
-    return SIGN_ALIASES.get(t)
+    return _SIGN_LOOKUP.get(t)
 
 def sign_keyboard() -> types.ReplyKeyboardMarkup:
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
@@ -94,10 +99,12 @@ def _pick(seq: list, seed: bytes, salt: str) -> str:
     idx = int(h, 16) % len(seq)
     return str(seq[idx])
 
+@functools.lru_cache(maxsize=32)
 def make_daily_text(sign: str, for_date: date) -> str:
     """
     Генерирует 3–4 коротких фразы и пару «фишек» (цвет, число).
-    Детерминированно для (sign, date) — без внешних API.
+    Детерминированно для (sign, date) — без внешних API, поэтому кэшируется:
+    12 знаков × сегодня/вчера; рассылка и /today не пересчитывают md5 на каждого пользователя.
     """
     iso = for_date.isoformat().encode("utf-8")
     sgn = sign.encode("utf-8")
@@ -123,38 +130,42 @@ def user_mention(m: types.Message) -> str:
     return f"{u.first_name or ''}".strip() or "друг"
 
 def parse_hour(token: str) -> int | None:
-    try:
-        h = int(token)
-        return h if 0 <= h <= 23 else None
-    except Exception:
+    # Проверка цифр вместо try/except: опечатки — частый случай, исключение тут лишнее
+    token = token.strip()
+    if not (token.isascii() and token.isdigit()):
         return None
+    h = int(token)
+    return h if 0 <= h <= 23 else None
 
 
 # ---------- команды ----------
-@bot.message_handler(commands=["start", "help"])
+# Приветствие статичное — собираем один раз при импорте
+START_TEXT = (
+    "Привет! Я пришлю *гороскоп дня* без всяких API — для настроения.\n\n"
+    "Сначала выбери знак и час отправки:\n"
+    "• /set_sign <знак>  или нажми кнопку со знаком\n"
+    "• /set_time <0..23> час (по времени сервера)\n\n"
+    "Полезное:\n"
+    "• /today — прислать на сегодня\n"
+    "• /subscribe и /unsubscribe\n"
+    "• /me — показать мои настройки\n"
+    "• /signs — список знаков\n"
+)
+
+# Клавиатура неизменна — сериализуем в JSON один раз: TeleBot вызывает to_json() у разметки
+# на каждой отправке, а готовую строку передаёт в API как есть
+SIGN_KEYBOARD = sign_keyboard().to_json()
+SIGNS_TEXT = "Доступные знаки:\n" + "\n".join(f"{SIGN_EMOJI[s]} {s.capitalize()}" for s in CANON_SIGNS)
+
 def cmd_start(message: types.Message) -> None:
     db.ensure_user(message.from_user.id)
-    text = (
-        "Привет! Я пришлю *гороскоп дня* без всяких API — для настроения.\n\n"
-        "Сначала выбери знак и час отправки:\n"
-        "• /set_sign <знак>  или нажми кнопку со знаком\n"
-        "• /set_time <0..23> час (по времени сервера)\n\n"
-        "Полезное:\n"
-        "• /today — прислать на сегодня\n"
-        "• /subscribe и /unsubscribe\n"
-        "• /me — показать мои настройки\n"
-        "• /signs — список знаков\n"
-    )
-    bot.send_message(message.chat.id, text, reply_markup=sign_keyboard(), parse_mode="Markdown")
+    bot.send_message(message.chat.id, START_TEXT, reply_markup=SIGN_KEYBOARD, parse_mode="Markdown")
 
 
-@bot.message_handler(commands=["signs"])
 def cmd_signs(message: types.Message) -> None:
-    lines = [f"{SIGN_EMOJI[s]} {s.capitalize()}" for s in CANON_SIGNS]
-    bot.reply_to(message, "Доступные знаки:\n" + "\n".join(lines))
+    bot.reply_to(message, SIGNS_TEXT)
 
 
-@bot.message_handler(commands=["set_sign"])
 def cmd_set_sign(message: types.Message) -> None:
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2:
@@ -164,38 +175,30 @@ def cmd_set_sign(message: types.Message) -> None:
     if not s:
         bot.reply_to(message, "Не узнал знак. Напиши один из: " + ", ".join(CANON_SIGNS))
         return
-    db.ensure_user(message.from_user.id)
     db.set_sign(message.from_user.id, s)
     bot.reply_to(message, f"Знак сохранён: {SIGN_EMOJI[s]} {s.capitalize()}")
 
 
-@bot.message_handler(commands=["set_time"])
 def cmd_set_time(message: types.Message) -> None:
     parts = message.text.split(maxsplit=1)
     hour = parse_hour(parts[1]) if len(parts) == 2 else None
     if hour is None:
         bot.reply_to(message, "Формат: /set_time <час 0..23>  (например: /set_time 9)")
         return
-    db.ensure_user(message.from_user.id)
     db.set_notify_hour(message.from_user.id, hour)
     bot.reply_to(message, f"Час отправки сохранён: {hour}:00")
 
 
-@bot.message_handler(commands=["subscribe"])
 def cmd_subscribe(message: types.Message) -> None:
-    db.ensure_user(message.from_user.id)
     db.set_subscribed(message.from_user.id, True)
     bot.reply_to(message, "Подписка включена. Я пришлю сообщение в заданный час.")
 
 
-@bot.message_handler(commands=["unsubscribe"])
 def cmd_unsubscribe(message: types.Message) -> None:
-    db.ensure_user(message.from_user.id)
     db.set_subscribed(message.from_user.id, False)
     bot.reply_to(message, "Подписка выключена.")
 
 
-@bot.message_handler(commands=["me"])
 def cmd_me(message: types.Message) -> None:
     row = db.get_user(message.from_user.id)
     if not row:
@@ -210,9 +213,7 @@ def cmd_me(message: types.Message) -> None:
     )
 
 
-@bot.message_handler(commands=["today"])
 def cmd_today(message: types.Message) -> None:
-    db.ensure_user(message.from_user.id)
     row = db.get_user(message.from_user.id)
     if not row or not row["sign"]:
         bot.reply_to(message, "Сначала /set_sign <знак>.")
@@ -222,14 +223,38 @@ def cmd_today(message: types.Message) -> None:
 
 
 # ---------- обработка нажатий по клавиатуре со знаками ----------
-@bot.message_handler(func=lambda m: (m.text or "").strip().lower() in CANON_SIGNS)
-def kb_pick_sign(message: types.Message) -> None:
-    s = (message.text or "").strip().lower()
-    db.ensure_user(message.from_user.id)
+def kb_pick_sign(message: types.Message, s: str) -> None:
     db.set_sign(message.from_user.id, s)
     bot.reply_to(message, f"Знак сохранён: {SIGN_EMOJI[s]} {s.capitalize()}")
 
 
+# ---------- маршрутизация: один обработчик вместо фильтра на каждую команду ----------
+COMMAND_HANDLERS = {
+    "start": cmd_start,
+    "help": cmd_start,
+    "signs": cmd_signs,
+    "set_sign": cmd_set_sign,
+    "set_time": cmd_set_time,
+    "subscribe": cmd_subscribe,
+    "unsubscribe": cmd_unsubscribe,
+    "me": cmd_me,
+    "today": cmd_today,
+}
+
+@bot.message_handler(content_types=["text"])
+def dispatch(message: types.Message) -> None:
+    # Текст разбираем один раз: команда — поиск в dict, кнопка со знаком — в множестве
+    text = message.text or ""
+    if text.startswith("/"):
+        handler = COMMAND_HANDLERS.get(text.split(None, 1)[0][1:].partition("@")[0])
+        if handler is not None:
+            handler(message)
+        return
+    s = text.strip().lower()
+    if s in _CANON_SET:
+        kb_pick_sign(message, s)
+
+
 # ---------- планировщик ежедневной отправки ----------
 def scheduler_loop() -> None:
     log.info("Scheduler started")
@@ -238,16 +263,16 @@ def scheduler_loop() -> None:
         today_str = now.strftime("%Y-%m-%d")
         hour = now.hour
         try:
-            due = db.list_due_users(today_str, hour)
-            for u in due:
+            # Забрать пользователей и сразу отметить отправку за сегодня (один запрос):
+            due = db.claim_due_users(today_str, hour)
+            for user_id, sign in due:
                 # Сгенерировать текст и отправить:
-                txt = make_daily_text(u["sign"], now.date())
+                txt = make_daily_text(sign, now.date())
                 try:
-                    bot.send_message(u["user_id"], txt, parse_mode="Markdown")
+                    bot.send_message(user_id, txt, parse_mode="Markdown")
                 except Exception as e:
-                    log.warning("Send failed to %s: %r", u["user_id"], e)
-                # Отметить отправку за сегодня:
-                db.mark_sent_today(u["user_id"], today_str)
+                    # Как и раньше, не повторяем в этот день (например, бот заблокирован)
+                    log.warning("Send failed to %s: %r", user_id, e)
         except Exception as e:
             log.exception("Scheduler error: %r", e)
         time.sleep(60)  # проверяем раз в минуту
@@ -259,22 +284,27 @@ def start_scheduler() -> None:
 
 
 # ---------- меню команд в клиенте (см. Л2) ----------
+BOT_COMMANDS = (
+    types.BotCommand("start", "Начало и помощь"),
+    types.BotCommand("set_sign", "Установить знак зодиака"),
+    types.BotCommand("set_time", "Установить час отправки"),
+    types.BotCommand("today", "Прислать на сегодня"),
+    types.BotCommand("subscribe", "Включить подписку"),
+    types.BotCommand("unsubscribe", "Выключить подписку"),
+    types.BotCommand("me", "Мои настройки"),
+    types.BotCommand("signs", "Список знаков"),
+)
+
 def setup_bot_commands() -> None:
-    cmds = [
-        types.BotCommand("start", "Начало и помощь"),
-        types.BotCommand("set_sign", "Установить знак зодиака"),
-        types.BotCommand("set_time", "Установить час отправки"),
-        types.BotCommand("today", "Прислать на сегодня"),
-        types.BotCommand("subscribe", "Включить подписку"),
-        types.BotCommand("unsubscribe", "Выключить подписку"),
-        types.BotCommand("me", "Мои настройки"),
-        types.BotCommand("signs", "Список знаков"),
-    ]
-    bot.set_my_commands(cmds)
+    try:
+        bot.set_my_commands(list(BOT_COMMANDS))
+    except Exception as e:
+        log.warning("set_my_commands failed: %r", e)
 
 
 # ---------- точка входа ----------
 if __name__ == "__main__":
-    setup_bot_commands()        # удобство для пользователей [oai_citation:8‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq)
+    # меню команд — в фоне, чтобы не задерживать старт polling
+    threading.Thread(target=setup_bot_commands, name="set-commands", daemon=True).start()  # удобство для пользователей [oai_citation:8‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq)
     start_scheduler()           # запускаем фоновую проверку
     bot.infinity_polling(skip_pending=True)  # запуск long polling (паттерн Л2/Л3) [oai_citation:9‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq) [oai_citation:10‡L3.pdf](file-service://file-TzQZFVK22mksuAGPBby5ME)
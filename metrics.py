@@ -25,17 +25,20 @@ class Counter:
         total.inc(5)
 
     Значения не сбрасываются автоматически при рестарте процесса.
+    Обработчики бота работают в пуле потоков, поэтому "+=" защищён блокировкой.
     """
 
     def __init__(self, name: str) -> None:
         self.name = name
         self.value = 0
+        self._lock = threading.Lock()
 
     def inc(self, amount: int = 1) -> None:
         # Увеличить счетчик на amount (по умолчанию на 1)
         if amount < 0:
             raise ValueError("Ошибка при увеличении счетчика метрик: количество должно быть >= 0")
-        self.value += amount
+        with self._lock:
+            self.value += amount
 
     def get(self) -> int:
         return self.value
@@ -89,9 +92,11 @@ class LatencyMetric:
     def __init__(self, name: str) -> None:
         self.name = name
         self.stats = LatencyStats()
+        self._lock = threading.Lock()
 
     def observe(self, ms: int) -> None:
-        self.stats.observe(ms)
+        with self._lock:
+            self.stats.observe(ms)
 
     def snapshot(self) -> Dict[str, Any]:
         """
@@ -100,8 +105,9 @@ class LatencyMetric:
         Возвращает dict с полями:
         count, total_ms, min_ms, max_ms, avg_ms
         """
-        data = asdict(self.stats)
-        data["avg_ms"] = self.stats.avg_ms
+        with self._lock:
+            data = asdict(self.stats)
+        data["avg_ms"] = data["total_ms"] / data["count"] if data["count"] else 0.0
         return data
 
 
@@ -131,6 +137,10 @@ class MetricsRegistry:
         Получить (или создать) счетчик с именем name.
         Если счетчик еще не зарегистрирован, создается новый.
         """
+        # Быстрый путь без блокировки: счетчики только добавляются, не удаляются
+        c = self._counters.get(name)
+        if c is not None:
+            return c
         with self._lock:
             c = self._counters.get(name)
             if c is None:
@@ -138,6 +148,23 @@ class MetricsRegistry:
                 self._counters[name] = c
             return c
 
+    def inc_many(self, *names: str) -> None:
+        """
+        Увеличить на 1 сразу несколько счетчиков — одна строка на обработчик:
+
+            metric.inc_many("commands_total", "note_add_requests_total")
+
+        Отсутствующие счетчики создаются под одной блокировкой реестра.
+        """
+        counters = self._counters
+        missing = [n for n in names if n not in counters]
+        if missing:
+            with self._lock:
+                for n in missing:
+                    counters.setdefault(n, Counter(n))
+        for n in names:
+            counters[n].inc()
+
     # --- Метрики задержки ---
 
     def latency(self, name: str) -> LatencyMetric:
@@ -146,6 +173,9 @@ class MetricsRegistry:
 
         Если не было — создается новая.
         """
+        m = self._latencies.get(name)
+        if m is not None:
+            return m
         with self._lock:
             m = self._latencies.get(name)
             if m is None:
@@ -211,6 +241,9 @@ def timed(metric_name: str, logger: logging.Logger | None = None) -> Callable[[C
     """
 
     def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        # Метрику находим один раз при декорировании, а не на каждый вызов
+        latency = metric.latency(metric_name)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs) -> T:
             t0 = time.perf_counter()
@@ -218,8 +251,9 @@ def timed(metric_name: str, logger: logging.Logger | None = None) -> Callable[[C
                 return func(*args, **kwargs)
             finally:
                 dt_ms = int((time.perf_counter() - t0) * 1000)
-                metric.latency(metric_name).observe(dt_ms)
+                latency.observe(dt_ms)
                 if logger is not None:
+                    # Ленивое форматирование: строка собирается, только если DEBUG включён
                     logger.debug("timed %s: %s ms", func.__qualname__, dt_ms)
 
         return wrapper
@@ -3,18 +3,78 @@
 """
 
 from __future__ import annotations
-import os, time, requests, json, logging
+import re, time, requests, json, logging, threading
+from concurrent.futures import Future
 from dataclasses import dataclass
-from typing import Dict, List, Tuple
-from dotenv import load_dotenv
+from typing import Callable, Dict, List, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import LLM_NUM_THREADS, OPENROUTER_API_KEY, OPENROUTER_MAX_RPS
 from db import write_service_call
 
 log = logging.getLogger(__name__)
 
-load_dotenv()
-
 OPENROUTER_API = "https://openrouter.ai/api/v1/chat/completions"
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+# Сколько символов запроса/ответа сохранять в service_call_log — журнал не разрастается
+# от длинных ответов и склеенных пачек вопросов
+JOURNAL_MAX_CHARS = 4096
+
+def _trim(s: str | None, n: int = JOURNAL_MAX_CHARS) -> str | None:
+    """
+    Обрезать строку для журнала; в конце помечаем, сколько символов отброшено.
+    """
+    if s is None or len(s) <= n:
+        return s
+    return f"{s[:n]}...[+{len(s) - n}]"
+
+
+class RateLimiter:
+    """
+    Простой token bucket: не больше rate запросов в секунду, всплеск до burst.
+    Лишние вызовы ждут своей очереди в процессе, а не получают 429 от сервиса.
+    """
+
+    def __init__(self, rate: float, burst: int | None = None) -> None:
+        self.rate = rate
+        self.capacity = float(burst or max(1, int(rate)))
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Дождаться разрешения на запрос; возвращает, сколько секунд ждали.
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+            self._ts = now
+            # Берём токен сразу (баланс может уйти в минус) — так очередь честная: FIFO по захвату lock
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+_limiter = RateLimiter(OPENROUTER_MAX_RPS)
+
+# Одна сессия на процесс: TCP+TLS до openrouter.ai устанавливается один раз и
+# переиспользуется (keep-alive) — без рукопожатия на каждый вопрос.
+# Пул соединений — по числу потоков _LLM_POOL в main.py. Повторяем только установку
+# соединения: POST к LLM не идемпотентен (повтор — второй платный ответ).
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=LLM_NUM_THREADS,
+    max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2),
+))
+_SESSION.headers.update({
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+})
 
 @dataclass
 class OpenRouterError(Exception):
@@ -23,14 +83,29 @@ class OpenRouterError(Exception):
     def __str__(self) -> str:
         return f"[{self.status}] {self.msg}"
 
+def prewarm(timeout_s: float = 5) -> None:
+    """
+    Заранее открыть соединение с openrouter.ai (DNS + TCP + TLS), чтобы первый /ask
+    после старта не платил за рукопожатие. Статус ответа не важен — соединение
+    остаётся в пуле _SESSION. Ошибки только логируем: старт бота от них не зависит.
+    """
+    try:
+        _SESSION.head(OPENROUTER_API, timeout=timeout_s)
+    except requests.RequestException as e:
+        log.info("OpenRouter: прогрев соединения не удался: %s", e)
+
+# HTTP-статус -> понятное пользователю сообщение (словарь собирается один раз при импорте)
+_FRIENDLY = {
+    400: "Неверный формат запроса.",
+    401: "Ключ OpenRouter отклонён. Проверьте OPENROUTER_API_KEY.",
+    403: "Нет прав доступа к модели.",
+    404: "Эндпоинт не найден. Проверьте URL /api/v1/chat/completions.",
+    429: "Превышены лимиты бесплатной модели. Попробуйте позднее.",
+}
+_FRIENDLY_DEFAULT = "Сервис недоступен. Повторите попытку позже."
+
 def _friendly(status: int) -> str:
-    return {
-        400: "Неверный формат запроса.",
-        401: "Ключ OpenRouter отклонён. Проверьте OPENROUTER_API_KEY.",
-        403: "Нет прав доступа к модели.",
-        404: "Эндпоинт не найден. Проверьте URL /api/v1/chat/completions.",
-        429: "Превышены лимиты бесплатной модели. Попробуйте позднее.",
-    }.get(status, "Сервис недоступен. Повторите попытку позже.")
+    return _FRIENDLY.get(status, _FRIENDLY_DEFAULT)
 
 def chat_once(messages: List[Dict], *,
               model: str,
@@ -41,10 +116,6 @@ def chat_once(messages: List[Dict], *,
         err = OpenRouterError(401, "Отсутствует OPENROUTER_API_KEY (.env).")
         log.error(err)
         raise err
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-    }
     payload = {
         "model": model,
         "messages": messages,
@@ -52,6 +123,8 @@ def chat_once(messages: List[Dict], *,
         "max_tokens": max_tokens,
     }
 
+    # Тело кодируем один раз и его же отправляем: json= в requests перекодировал бы
+    # payload заново и с ensure_ascii=True (кириллица -> \uXXXX, в ~3 раза длиннее).
     request_str = json.dumps(payload, ensure_ascii=False)
     log.debug(
         "Запрос к OpenRouter: model=%s, temperature=%s, max_tokens=%s",
@@ -60,20 +133,27 @@ def chat_once(messages: List[Dict], *,
         max_tokens
     )
 
+    waited = _limiter.acquire()
+    if waited:
+        log.debug("OpenRouter: ожидание лимита запросов %.3f с", waited)
+
     t0 = time.perf_counter()
-    r = requests.post(OPENROUTER_API, json=payload, headers=headers, timeout=timeout_s)
+    r = _SESSION.post(OPENROUTER_API, data=request_str.encode("utf-8"), timeout=timeout_s)
     dt_ms = int((time.perf_counter() - t0) * 1000)
 
     if r.status_code // 100 != 2:
         raise OpenRouterError(r.status_code, _friendly(r.status_code))
     try:
-        data = r.json()
+        # Тело ответа декодируем один раз: та же строка идёт и в json.loads, и в журнал
+        # (r.json() и r.text декодировали бы content каждый по отдельности)
+        response_str = r.content.decode("utf-8")
+        data = json.loads(response_str)
         text = data["choices"][0]["message"]["content"]
 
         write_service_call(
             service="openrouter",
-            request=request_str,
-            response=r.text,
+            request=_trim(request_str),
+            response=_trim(response_str),
             status_code=r.status_code,
             duration_ms=dt_ms,
             error=None if r.status_code // 100 == 2 else _friendly(r.status_code),
@@ -82,7 +162,7 @@ def chat_once(messages: List[Dict], *,
         log.error(e)
         write_service_call(
             service="openrouter",
-            request=request_str,
+            request=_trim(request_str),
             response=None,
             status_code=None,
             duration_ms=None,
@@ -91,3 +171,106 @@ def chat_once(messages: List[Dict], *,
         raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
 
     return text, dt_ms
+
+
+# ---------- склейка одновременных вопросов в один запрос ----------
+_BATCH_INSTRUCTION = (
+    "\n\nВ сообщении пользователя несколько независимых вопросов, каждый после строки «### Q<номер>». "
+    "Ответь на каждый отдельно, в том же порядке; каждый ответ начинай со строки «### A<номер>» "
+    "и больше ничего вне ответов не пиши."
+)
+_BATCH_ANSWER_RE = re.compile(r"^### A(\d+)[ \t]*$", re.M)
+# Строки вопроса, похожие на наши маркеры («### Q2», «## a1 ...»): вопросы разных
+# пользователей идут в один запрос, и такой строкой можно сдвинуть чужие ответы
+_BATCH_MARKER_IN_QUESTION_RE = re.compile(r"^[ \t]*#+(?=[ \t]*[QA][ \t]*\d)", re.M | re.I)
+
+
+class BatchedAsker:
+    """
+    Склеивает одновременные вопросы к одной модели с одним system-промптом в один запрос к OpenRouter.
+
+    Первый пришедший вопрос ждёт window_s секунд (или пока не наберётся max_batch), собирая соседей;
+    затем уходит один запрос с пронумерованными вопросами, ответ делится по «### A<номер>».
+    Если ответ не удалось разобрать — каждый вопрос отправляется отдельно, как без склейки.
+    Интерфейс ask() совпадает с chat_once().
+    """
+
+    def __init__(self, window_s: float = 0.1, max_batch: int = 8,
+                 chat: Callable[..., Tuple[str, int]] | None = None) -> None:
+        self.window_s = window_s
+        self.max_batch = max_batch
+        self._chat = chat or chat_once
+        self._lock = threading.Lock()
+        self._pending: Dict[tuple, dict] = {}
+
+    def ask(self, messages: List[Dict], *, model: str, temperature: float = 0.2,
+            max_tokens: int = 400, timeout_s: int = 30) -> Tuple[str, int]:
+        # Склеиваем только пары system + user — иначе отправляем как есть
+        if len(messages) != 2 or messages[0]["role"] != "system" or messages[1]["role"] != "user":
+            return self._chat(messages, model=model, temperature=temperature,
+                              max_tokens=max_tokens, timeout_s=timeout_s)
+
+        key = (model, messages[0]["content"], temperature, max_tokens)
+        fut: Future = Future()
+        with self._lock:
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending[key] = {"items": [], "full": threading.Event()}
+            batch["items"].append((messages[1]["content"], fut))
+            if len(batch["items"]) >= self.max_batch:
+                # Партия набрана — следующие вопросы начнут новую
+                del self._pending[key]
+                batch["full"].set()
+
+        if leader:
+            batch["full"].wait(self.window_s)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            self._run(batch["items"], messages[0], model=model, temperature=temperature,
+                      max_tokens=max_tokens, timeout_s=timeout_s)
+
+        result = fut.result()
+        if result is None:
+            # Склейка не удалась — обычный одиночный запрос
+            return self._chat(messages, model=model, temperature=temperature,
+                              max_tokens=max_tokens, timeout_s=timeout_s)
+        return result
+
+    def _run(self, items: list, system: Dict, **kw) -> None:
+        if len(items) == 1:
+            items[0][1].set_result(None)
+            return
+        # Решётки в начале строк-«маркеров» внутри вопроса убираем: «### A1» -> « A1»
+        user_text = "\n\n".join(
+            f"### Q{i}\n{_BATCH_MARKER_IN_QUESTION_RE.sub('', q)}" for i, (q, _) in enumerate(items, 1)
+        )
+        batch_messages = [
+            {"role": "system", "content": system["content"] + _BATCH_INSTRUCTION},
+            {"role": "user", "content": user_text},
+        ]
+        kw["max_tokens"] = kw["max_tokens"] * len(items)
+        try:
+            text, ms = self._chat(batch_messages, **kw)
+        except Exception as e:
+            for _, fut in items:
+                fut.set_exception(e)
+            return
+
+        answers = self._split(text or "", len(items))
+        log.debug("OpenRouter: склеено вопросов %s, разбор %s", len(items), "ok" if answers else "не удался")
+        for i, (_, fut) in enumerate(items):
+            fut.set_result((answers[i], ms) if answers else None)
+
+    @staticmethod
+    def _split(text: str, n: int) -> List[str] | None:
+        """
+        Разбить ответ по «### A<номер>»; None — если номера не 1..n по порядку.
+        """
+        parts = _BATCH_ANSWER_RE.split(text)
+        # parts = [до первого маркера, "1", ответ1, "2", ответ2, ...]
+        nums = parts[1::2]
+        if nums != [str(i) for i in range(1, n + 1)]:
+            return None
+        return [a.strip() for a in parts[2::2]]
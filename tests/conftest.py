@@ -17,7 +17,9 @@ def db_module(tmp_db_path, monkeypatch):
     # на случай, если DB_PATH читается из config:
     monkeypatch.setattr(db, "DB_PATH", tmp_db_path, raising=False)
     db.init_db()
-    return db
+    yield db
+    # журналы пишутся фоновым потоком — дописываем их, пока DB_PATH ещё временный
+    db.flush_logs()
 
 @pytest.fixture()
 def main_module(db_module, monkeypatch):
@@ -28,8 +30,8 @@ def main_module(db_module, monkeypatch):
     return main
 
 @pytest.fixture()
-def openrouter_module():
+def openrouter_module(db_module):
     """
-    Импортируем openrouter_client.py
+    Импортируем openrouter_client.py (журнал вызовов пишется во временную БД)
     """
     return importlib.import_module("openrouter_client")
@@ -0,0 +1,25 @@
+import importlib.util
+import os
+import shutil
+from pathlib import Path
+
+def test_env_file_is_read_when_token_is_exported(tmp_path, monkeypatch):
+    """
+    TOKEN экспортирован, остальное лежит в .env — config всё равно берёт значения из .env
+    """
+    # Копия config.py рядом с временным .env: load_dotenv ищет .env от каталога модуля
+    src = Path(__file__).resolve().parent.parent / "config.py"
+    shutil.copy(src, tmp_path / "config.py")
+    (tmp_path / ".env").write_text("OPENROUTER_API_KEY=sk-test\n", encoding="utf-8")
+
+    # Отдельная копия окружения: то, что допишет load_dotenv, не утечёт в другие тесты
+    env = {k: v for k, v in os.environ.items() if k != "OPENROUTER_API_KEY"}
+    env["TOKEN"] = "1:a"
+    monkeypatch.setattr(os, "environ", env)
+
+    spec = importlib.util.spec_from_file_location("config_under_test", tmp_path / "config.py")
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+
+    assert config.TOKEN == "1:a"
+    assert config.OPENROUTER_API_KEY == "sk-test"
@@ -1,3 +1,5 @@
+import sqlite3
+
 import pytest
 
 def test_character_upsert(db_module):
@@ -35,8 +37,7 @@ def test_models_single_active_switch(db_module):
     assert act2["id"] == b
 
     # Ровно одна активная
-    with db._connect() as conn:
-        cnt = conn.execute("SELECT COUNT(*) FROM models WHERE active=1").fetchone()[0]
+    cnt = sum(m["active"] for m in db.list_models())
     assert cnt == 1, "Должна быть ровно одна активная модель"
 
 def test_set_active_model_rejects_unknown_id(db_module):
@@ -66,3 +67,435 @@ def test_get_user_character_falls_back_to_default(db_module):
 
     ids = {c["id"] for c in all_chars}
     assert ch["id"] in ids, "get_user_character должен возвращать одного из существующих персонажей"
+
+def test_connect_reuses_pooled_connection(db_module):
+    db = db_module
+
+    with db._connect() as c1:
+        pass
+    with db._connect() as c2:
+        pass
+
+    # Подключение возвращается в пул и переиспользуется следующей операцией
+    assert c1 is c2
+
+def test_connection_pragmas_applied_once(db_module):
+    db = db_module
+
+    with db._connect() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        # synchronous=NORMAL -> 1
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+        assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+def test_search_notes_substring_case_insensitive(db_module):
+    db = db_module
+    uid = 555001
+
+    db.add_note(uid, "Купить Хлебушек")
+    db.add_note(uid, "позвонить маме")
+    db.add_note(555002, "хлеб чужой")
+
+    found = [r[1] for r in db.search_notes(uid, "хлеб")]
+    assert found == ["Купить Хлебушек"]
+
+    # Короткая подстрока — запасной путь через LIKE
+    assert [r[1] for r in db.search_notes(uid, "ма")] == ["позвонить маме"]
+
+    # Индекс следует за изменениями заметок
+    note_id = db.list_notes(uid, limit=10)[-1][0]
+    db.update_note(uid, note_id, "купить молоко")
+    assert db.search_notes(uid, "хлеб") == []
+    assert [r[0] for r in db.search_notes(uid, "молоко")] == [note_id]
+
+def test_search_notes_prefix_uses_range(db_module):
+    db = db_module
+    uid = 555003
+
+    db.add_note(uid, "Buy bread")
+    db.add_note(uid, "bread buy")
+    db.add_note(uid, "buy_milk")
+
+    assert [r[1] for r in db.search_notes(uid, "buy", prefix=True)] == ["buy_milk", "Buy bread"]
+    # "_" в префиксном режиме — обычный символ, а не шаблон LIKE
+    assert [r[1] for r in db.search_notes(uid, "buy_", prefix=True)] == ["buy_milk"]
+
+    # Регистр не ASCII тоже не важен — как в обычном /note_find через FTS5
+    db.add_note(uid, "Купить хлеб")
+    assert [r[1] for r in db.search_notes(uid, "кУПИТЬ", prefix=True)] == ["Купить хлеб"]
+    assert [r[1] for r in db.search_notes(uid, "Купить")] == ["Купить хлеб"]
+
+    # План того самого запроса, который выполняет search_notes, — на статистике по
+    # заметной таблице (на трёх строках полный просмотр честно дешевле индекса)
+    for other in range(20):
+        db.add_notes_bulk(uid + 1000 + other, (f"заметка {i}" for i in range(50)))
+    with db._connect() as conn:
+        conn.execute("ANALYZE")
+        plan = " ".join(
+            r[-1] for r in conn.execute(
+                "EXPLAIN QUERY PLAN " + db._SQL_NOTES_PREFIX,
+                (uid, "buy", db._prefix_upper_bound("buy"), 10),
+            )
+        )
+    assert "idx_notes_user_fold" in plan
+
+def test_notes_fold_migrated_from_udf_index(db_module):
+    db = db_module
+    uid = 555005
+    db.add_note(uid, "Купить хлеб")
+    # БД версии 3: без text_fold, поиск по началу — индекс на Python-функции py_lower
+    conn = sqlite3.connect(db.DB_PATH)
+    try:
+        conn.create_function("py_lower", 1, str.lower, deterministic=True)
+        conn.executescript(
+            "DROP INDEX idx_notes_user_fold; ALTER TABLE notes DROP COLUMN text_fold; "
+            "CREATE INDEX idx_notes_user_py_lower ON notes(user_id, py_lower(text), text); "
+            "PRAGMA user_version = 3;"
+        )
+    finally:
+        conn.close()
+    db.init_db()
+
+    assert [r[1] for r in db.search_notes(uid, "купить", prefix=True)] == ["Купить хлеб"]
+    # Подключению без функций бота БД снова доступна целиком
+    conn = sqlite3.connect(db.DB_PATH)
+    try:
+        conn.execute("INSERT INTO notes(user_id, text) VALUES (?, 'x')", (uid,))
+        conn.commit()
+        assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    finally:
+        conn.close()
+
+def test_search_notes_prefix_at_code_point_edges(db_module):
+    db = db_module
+    uid = 555004
+
+    # Последний символ префикса — край диапазона кодовых точек: граница не ломается
+    db.add_note(uid, "a\U0010ffff b")
+    db.add_note(uid, "z\ud7ff c")
+    db.add_note(uid, "z\ue000 d")
+    assert [r[1] for r in db.search_notes(uid, "a\U0010ffff", prefix=True)] == ["a\U0010ffff b"]
+    assert [r[1] for r in db.search_notes(uid, "z\ud7ff", prefix=True)] == ["z\ud7ff c"]
+    assert db.search_notes(uid, "\U0010ffff", prefix=True) == []
+    assert db._prefix_upper_bound("a\U0010ffff") == "b"
+    assert db._prefix_upper_bound("\U0010ffff") is None
+
+def test_mark_sent_today_bulk(db_module):
+    db = db_module
+    uids = [880001, 880002, 880003]
+    for uid in uids:
+        db.ensure_user(uid)
+        db.set_sign(uid, "лев")
+        db.set_notify_hour(uid, 9)
+
+    assert {r["user_id"] for r in db.list_due_users("2025-01-01", 9)} >= set(uids)
+
+    db.mark_sent_today_bulk(uids[:2], "2025-01-01")
+    db.mark_sent_today(uids[2], "2025-01-01")
+
+    assert not {r["user_id"] for r in db.list_due_users("2025-01-01", 9)} & set(uids)
+
+def test_get_active_model_bootstraps_first_model(db_module):
+    db = db_module
+    with db._connect() as conn:
+        conn.execute("DELETE FROM active_model")
+    db.clear_caches()
+
+    act = db.get_active_model()
+    first = db.list_models()[0]
+    assert act["id"] == first["id"]
+    assert first["active"] is True
+
+def test_set_active_model_unknown_id_keeps_current(db_module):
+    db = db_module
+    models = db.list_models()
+    db.set_active_model(models[-1]["id"])
+
+    with pytest.raises(ValueError):
+        db.set_active_model(999999)
+
+    # Неудачное переключение откатывается целиком
+    assert db.get_active_model()["id"] == models[-1]["id"]
+
+    # Переключение «вниз» по id тоже работает
+    act = db.set_active_model(models[0]["id"])
+    assert act["id"] == models[0]["id"]
+
+def test_profile_setters_upsert_missing_user(db_module):
+    db = db_module
+    uid = 880101
+    assert db.get_user(uid) is None
+
+    db.set_sign(uid, "рыбы")
+    row = db.get_user(uid)
+    assert row["sign"] == "рыбы"
+    assert row["subscribed"] == 1
+
+    db.set_notify_hour(uid, 21)
+    db.set_subscribed(uid, False)
+    row = db.get_user(uid)
+    assert (row["sign"], row["notify_hour"], row["subscribed"]) == ("рыбы", 21, 0)
+
+def test_list_notes_uses_covering_index(db_module):
+    db = db_module
+    with db._connect() as conn:
+        plan = " ".join(
+            r[-1] for r in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id, text, created_at FROM notes "
+                "WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (1, 10),
+            )
+        )
+    assert "COVERING INDEX idx_notes_user_id_covering" in plan
+
+def test_claim_due_users_claims_once(db_module):
+    db = db_module
+    uid = 880201
+    db.set_sign(uid, "дева")
+    db.set_notify_hour(uid, 7)
+
+    first = db.claim_due_users("2025-02-02", 7)
+    assert [r for r in first if r[0] == uid] == [(uid, "дева")]
+
+    # Повторный тик в тот же день ничего не возвращает
+    assert uid not in {user_id for user_id, _ in db.claim_due_users("2025-02-02", 7)}
+    assert db.get_user(uid)["last_sent_date"] == "2025-02-02"
+
+def test_due_users_query_uses_partial_index(db_module):
+    db = db_module
+    with db._connect() as conn:
+        plan = " ".join(
+            r[-1] for r in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT user_id, sign FROM users "
+                "WHERE subscribed = 1 AND sign IS NOT NULL AND notify_hour = ? "
+                "AND (last_sent_date IS NULL OR last_sent_date <> ?)",
+                (9, "2025-01-01"),
+            )
+        )
+    assert "COVERING INDEX idx_users_due_covering" in plan
+
+def test_backup_to_copies_notes(db_module, tmp_path):
+    import sqlite3
+
+    db = db_module
+    db.add_note(880301, "в бэкап")
+    target = str(tmp_path / "backup.db")
+
+    db.backup_to(target, pages=1, sleep=0)
+
+    conn = sqlite3.connect(target)
+    try:
+        texts = [r[0] for r in conn.execute("SELECT text FROM notes WHERE user_id = 880301")]
+        assert texts == ["в бэкап"]
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    finally:
+        conn.close()
+
+def test_post_init_maintenance_keeps_query_plans(db_module):
+    db = db_module
+    db.add_note(880401, "анализ")
+    db._post_init_maintenance()
+
+    with db._connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0] > 0
+        plan = " ".join(
+            r[-1] for r in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id, text, created_at FROM notes "
+                "WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (880401, 10),
+            )
+        )
+    assert "idx_notes_user_id_covering" in plan
+
+def test_error_log_written_in_background(db_module):
+    db = db_module
+    db.write_error_log(level="ERROR", logger_name="test", message="boom", user_id=1, command="/x")
+    db.write_service_call(service="svc", request="{}", response=None, status_code=None, duration_ms=None)
+    db.flush_logs()
+
+    with db._connect() as conn:
+        message, created_at = conn.execute(
+            "SELECT message, created_at FROM error_log WHERE logger = 'test'"
+        ).fetchone()
+        assert message == "boom"
+        assert len(created_at) == 19 and created_at[10] == "T"
+        assert conn.execute("SELECT COUNT(*) FROM service_call_log WHERE service = 'svc'").fetchone()[0] == 1
+
+def test_add_notes_bulk_skips_empty_duplicates_and_too_long(db_module):
+    db = db_module
+    uid = 880501
+    db.add_note(uid, "уже есть")
+
+    added = db.add_notes_bulk(uid, ["раз", "  ", "два", "раз", "уже есть", "x" * 501])
+
+    assert added == 2
+    assert db.count_notes(uid) == 3
+
+def test_active_model_and_character_cached_until_changed(db_module):
+    db = db_module
+    uid = 880601
+    models = db.list_models()
+    characters = db.list_characters()
+
+    db.set_active_model(models[1]["id"])
+    db.set_user_character(uid, characters[1]["id"])
+
+    # Чтения берутся из кэша: правка таблиц в обход API не видна...
+    with db._connect() as conn:
+        conn.execute("DELETE FROM user_character WHERE telegram_user_id = ?", (uid,))
+    assert db.get_user_character(uid)["id"] == characters[1]["id"]
+    assert db.get_active_model()["id"] == models[1]["id"]
+
+    # Каталог персонажей тоже из кэша; get_character_by_id отдаёт копию
+    db.get_character_by_id(characters[0]["id"])["name"] = "испорчено"
+    assert db.get_character_by_id(characters[0]["id"])["name"] == characters[0]["name"]
+    with db._connect() as conn:
+        conn.execute("UPDATE characters SET name = 'в обход' WHERE id = ?", (characters[0]["id"],))
+    assert db.list_characters()[0]["name"] == characters[0]["name"]
+
+    # ...а изменения через API обновляют кэш сразу
+    db.set_active_model(models[2]["id"])
+    db.set_user_character(uid, characters[2]["id"])
+    assert db.get_active_model()["id"] == models[2]["id"]
+    assert db.get_user_character(uid)["id"] == characters[2]["id"]
+
+def test_stats_by_date_groups_without_temp_btree(db_module):
+    db = db_module
+    db.add_note(880701, "сегодня")
+    assert [r["total"] for r in db.stats_by_date(880701, days=7)] == [1]
+
+    with db._connect() as conn:
+        plan = " ".join(
+            r[-1] for r in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT date(created_at) AS d, COUNT(*) AS total "
+                "FROM notes WHERE user_id = ? GROUP BY date(created_at) ORDER BY d DESC LIMIT ?",
+                (880701, 7),
+            )
+        )
+    assert "idx_notes_user_date" in plan
+    assert "TEMP B-TREE" not in plan
+
+def test_search_notes_falls_back_to_like_without_fts(db_module):
+    db = db_module
+    uid = 880801
+    db.add_note(uid, "купить хлеб")
+    with db._connect() as conn:
+        conn.executescript(
+            "DROP TRIGGER notes_fts_ai; DROP TRIGGER notes_fts_ad; "
+            "DROP TRIGGER notes_fts_au; DROP TABLE notes_fts;"
+        )
+
+    assert [r[1] for r in db.search_notes(uid, "хлеб")] == ["купить хлеб"]
+
+    # Следующий старт (версия схемы та же) восстанавливает notes_fts и индексирует заметки
+    db.init_db()
+    with db._connect() as conn:
+        assert conn.execute(
+            "SELECT rowid FROM notes_fts WHERE notes_fts MATCH ?", ('"хлеб"',)
+        ).fetchall()
+
+def test_init_db_skips_schema_when_version_current(db_module):
+    db = db_module
+    with db._connect() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == db.SCHEMA_VERSION
+        conn.execute("DELETE FROM characters WHERE id = 11")
+
+    # Тёплый старт: справочники не пересеиваются
+    db.init_db()
+    assert 11 not in {c["id"] for c in db.list_characters()}
+
+    # Смена версии — схема и справочники применяются заново
+    with db._connect() as conn:
+        conn.execute("PRAGMA user_version = 0")
+    db.init_db()
+    assert 11 in {c["id"] for c in db.list_characters()}
+
+def test_add_note_duplicate_returns_none(db_module):
+    db = db_module
+    uid = 880901
+    first = db.add_note(uid, "одна и та же")
+    assert first is not None
+    assert db.add_note(uid, "одна и та же") is None
+    assert db.add_note(uid, "x" * 501) is None
+    assert db.count_notes(uid) == 1
+
+def test_active_model_migrated_from_legacy_flag(db_module):
+    db = db_module
+    # БД старой версии: активная модель отмечена только флагом models.active
+    with db._connect() as conn:
+        conn.execute("DROP TABLE active_model")
+        conn.execute("UPDATE models SET active = (id = 3)")
+        conn.execute("PRAGMA user_version = 1")
+    db.init_db()
+
+    assert db.get_active_model()["id"] == 3
+    assert [m["id"] for m in db.list_models() if m["active"]] == [3]
+
+def test_ensure_user_skips_sql_for_known_user(db_module):
+    db = db_module
+    uid = 881001
+    db.ensure_user(uid)
+    assert db.get_user(uid) is not None
+
+    # Повторный вызов не ходит в БД: строку, удалённую в обход API, не восстанавливает...
+    with db._connect() as conn:
+        conn.execute("DELETE FROM users WHERE user_id = ?", (uid,))
+    db.ensure_user(uid)
+    assert db.get_user(uid) is None
+
+    # ...пока кэш не сброшен
+    db.clear_caches()
+    db.ensure_user(uid)
+    assert db.get_user(uid) is not None
+
+def test_export_notes_not_capped_by_chat_limit(db_module):
+    db = db_module
+    uid = 881101
+    db.add_notes_bulk(uid, [f"заметка {i}" for i in range(60)])
+
+    assert len(db.list_notes(uid, limit=1000)) == 50
+    rows = db.export_notes(uid)
+    assert len(rows) == 60
+    assert rows[0][1] == "заметка 59"
+
+def test_get_random_character_returns_full_record(db_module):
+    db = db_module
+    ids = {c["id"] for c in db.list_characters()}
+    character = db.get_random_character()
+    assert character["id"] in ids
+    assert character["prompt"]
+
+def test_get_whoami_matches_separate_lookups(db_module):
+    db = db_module
+    uid = 881201
+    characters = db.list_characters()
+    models = db.list_models()
+    db.set_active_model(models[1]["id"])
+    db.set_user_character(uid, characters[2]["id"])
+
+    db.clear_caches()
+    character, model = db.get_whoami(uid)
+    assert (character["id"], model["id"]) == (characters[2]["id"], models[1]["id"])
+    # Пользователь без выбранного персонажа — персонаж по умолчанию
+    assert db.get_whoami(881202)[0] == db.get_user_character(881202)
+
+def test_read_pool_is_separate_and_read_only(db_module):
+    db = db_module
+    import sqlite3
+
+    with db._read() as r1:
+        pass
+    with db._read() as r2:
+        with db._connect() as w:
+            pass
+    assert r1 is r2
+    assert w is not r1
+
+    with pytest.raises(sqlite3.OperationalError):
+        with db._read() as conn:
+            conn.execute("DELETE FROM notes")
+
+    # Запись через _connect сразу видна читателям
+    uid = 881301
+    db.add_note(uid, "видно читателю")
+    assert db.count_notes(uid) == 1
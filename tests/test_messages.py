@@ -61,3 +61,148 @@ def test_build_messages_for_character_pure_function(main_module):
 
     assert msgs[1]["role"] == "user"
     assert question in msgs[1]["content"]
+
+def test_cmd_args_strips_command_and_bot_suffix(main_module):
+    main = main_module
+
+    assert main._cmd_args("/note_add купить хлеб") == "купить хлеб"
+    assert main._cmd_args("/model@MyBot 3") == "3"
+    assert main._cmd_args("/note_import\nраз\nдва") == "раз\nдва"
+    assert main._cmd_args("/note_list") == ""
+    assert main._parse_int(" 12 ") == 12
+    assert main._parse_int("12a") is None
+
+def test_dispatch_routes_by_command_name(main_module, monkeypatch):
+    main = main_module
+    calls = []
+    monkeypatch.setitem(main._HANDLERS, "note_count", lambda msg: calls.append(msg.text))
+
+    assert main._command_name("/ask_random@MyBot кто ты?") == "ask_random"
+    assert main._command_name("/model\n3") == "model"
+    assert main._command_name("просто текст") is None
+
+    for text in ("/note_count@MyBot", "/note_counter", "/unknown", "привет"):
+        main._dispatch(type("Msg", (), {"text": text})())
+    assert calls == ["/note_count@MyBot"]
+
+def test_ask_llm_caches_identical_questions(main_module, monkeypatch):
+    main = main_module
+    calls = []
+
+    def fake_chat(msgs, **kw):
+        calls.append(msgs)
+        return f"ответ {len(calls)}", 120
+
+    monkeypatch.setattr(main, "chat_once", fake_chat)
+    main._llm_cache.clear()
+    system = {"role": "system", "content": "персонаж"}
+
+    assert main._ask_llm([system, {"role": "user", "content": "Столица Франции?"}], "m") == ("ответ 1", 120, False)
+    # Регистр и лишние пробелы не важны — ответ из кэша, без запроса
+    assert main._ask_llm([system, {"role": "user", "content": "столица  франции?"}], "m") == ("ответ 1", 0, True)
+    # Другая модель — другой ключ
+    assert main._ask_llm([system, {"role": "user", "content": "Столица Франции?"}], "m2")[2] is False
+    assert len(calls) == 2
+
+def test_ask_llm_joins_identical_inflight_question(main_module, monkeypatch):
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    main = main_module
+    calls = []
+    release = threading.Event()
+
+    def fake_chat(msgs, **kw):
+        calls.append(msgs)
+        release.wait(5)
+        return "ответ", 120
+
+    monkeypatch.setattr(main, "chat_once", fake_chat)
+    main._llm_cache.clear()
+    msgs = [{"role": "system", "content": "персонаж"}, {"role": "user", "content": "Сколько времени?"}]
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        first = pool.submit(main._ask_llm, msgs, "m")
+        while not calls:
+            time.sleep(0.01)
+        # Второй такой же вопрос приходит, пока первый ещё ждёт ответа модели
+        second = pool.submit(main._ask_llm, msgs, "m")
+        time.sleep(0.05)
+        release.set()
+
+        assert first.result(timeout=5) == ("ответ", 120, False)
+        assert second.result(timeout=5) == ("ответ", 0, True)
+    assert len(calls) == 1
+    assert main._llm_inflight == {}
+
+def test_clip_bytes_keeps_whole_characters(main_module):
+    main = main_module
+    assert main._clip_bytes("привет", 100) == "привет"
+    # 5 байт = 2 кириллических символа + половина третьего, которая отбрасывается
+    assert main._clip_bytes("привет", 5) == "пр"
+
+def test_ask_and_reply_runs_in_llm_pool(main_module, monkeypatch):
+    import contextlib
+    import threading
+    from types import SimpleNamespace
+
+    main = main_module
+    replies = []
+    monkeypatch.setattr(main, "_typing", lambda chat_id: contextlib.nullcontext())
+    monkeypatch.setattr(main, "_ask_llm", lambda msgs, key: (threading.current_thread().name, 5, False))
+    monkeypatch.setattr(main.bot, "reply_to", lambda msg, text: replies.append(text))
+
+    msg = SimpleNamespace(from_user=SimpleNamespace(id=1), chat=SimpleNamespace(id=1))
+    main._ask_and_reply(msg, [], "m", command="/ask", footer=False).result(timeout=5)
+
+    assert replies and replies[0].startswith("llm")
+
+def test_ask_and_reply_serializes_per_chat(main_module, monkeypatch):
+    import contextlib
+    import threading
+    import time
+    from types import SimpleNamespace
+
+    main = main_module
+    replies = []
+    gate = threading.Event()
+
+    def fake_ask(msgs, key):
+        if msgs == ["первый"]:
+            gate.wait(5)
+        return msgs[0], 5, False
+
+    monkeypatch.setattr(main, "_typing", lambda chat_id: contextlib.nullcontext())
+    monkeypatch.setattr(main, "_ask_llm", fake_ask)
+    monkeypatch.setattr(main.bot, "reply_to", lambda msg, text: replies.append((msg.chat.id, text)))
+
+    def msg(chat_id):
+        return SimpleNamespace(from_user=SimpleNamespace(id=chat_id), chat=SimpleNamespace(id=chat_id))
+
+    first = main._ask_and_reply(msg(1), ["первый"], "m", command="/ask", footer=False)
+    second = main._ask_and_reply(msg(1), ["второй"], "m", command="/ask", footer=False)
+    other = main._ask_and_reply(msg(2), ["другой чат"], "m", command="/ask", footer=False)
+
+    # Другой чат не ждёт зависший запрос первого, а второй вопрос чата 1 — ждёт
+    other.result(timeout=5)
+    time.sleep(0.05)
+    assert replies == [(2, "другой чат")]
+
+    gate.set()
+    first.result(timeout=5)
+    second.result(timeout=5)
+    assert replies[1:] == [(1, "первый"), (1, "второй")]
+
+def test_ask_and_reply_rejects_when_queue_is_full(main_module, monkeypatch):
+    from types import SimpleNamespace
+
+    main = main_module
+    replies = []
+    monkeypatch.setattr(main, "LLM_MAX_PENDING", 0)
+    monkeypatch.setattr(main.bot, "reply_to", lambda msg, text: replies.append(text))
+
+    msg = SimpleNamespace(from_user=SimpleNamespace(id=1), chat=SimpleNamespace(id=1))
+    main._ask_and_reply(msg, [], "m", command="/ask").result(timeout=1)
+
+    assert replies and "перегружен" in replies[0]
@@ -1,6 +1,6 @@
 import json
 import responses
-from importlib import reload
+from importlib import import_module, reload
 import pytest
 
 @responses.activate
@@ -10,35 +10,58 @@ def test_chat_once_ok_headers_and_body(openrouter_module, monkeypatch):
     payload = {"id": "cmpl_1", "choices": [{"message": {"content": "OK"}}]}
     responses.add(responses.POST, url, json=payload, status=200)
 
-    monkeypatch.setenv("OPENROUTER_API_KEY", "test-key")
-    openrouter_module = reload(openrouter_module)  # перечитает ключ
+    config = import_module("config")  # здесь, а не при сборе тестов: config требует TOKEN
+    monkeypatch.setattr(config, "OPENROUTER_API_KEY", "test-key")
+    openrouter_module = reload(openrouter_module)  # перечитает ключ из config
     chat_once = openrouter_module.chat_once
 
     text, ms = chat_once(
-        messages=[{"role": "user", "content": "ping"}],
+        messages=[{"role": "user", "content": "привет"}],
         model="mistralai/mistral-small-24b-instruct-2501:free",
         temperature=0.2,
         max_tokens=32,
         timeout_s=5,
     )
     assert text == "OK"
-    # Проверяем отправленное тело
-    sent = json.loads(responses.calls[0].request.body.decode())
+    # Проверяем отправленное тело: кириллица уходит как UTF-8, без \uXXXX
+    body = responses.calls[0].request.body
+    assert "привет".encode("utf-8") in body
+    sent = json.loads(body.decode())
     assert sent["model"].endswith(":free")
-    assert sent["messages"][0]["role"] == "user"
+    assert sent["messages"][0]["content"] == "привет"
     assert "temperature" in sent and "max_tokens" in sent
     # и заголовки
     hdrs = responses.calls[0].request.headers
     assert hdrs["Content-Type"] == "application/json"
     assert hdrs["Authorization"] == "Bearer test-key"
 
+@responses.activate
+def test_chat_once_journal_is_size_capped(db_module, openrouter_module, monkeypatch):
+    url = "https://openrouter.ai/api/v1/chat/completions"
+    monkeypatch.setattr(openrouter_module, "OPENROUTER_API_KEY", "test-key")
+    long_answer = "я" * (openrouter_module.JOURNAL_MAX_CHARS * 2)
+    responses.add(responses.POST, url, json={"choices": [{"message": {"content": long_answer}}]}, status=200)
+
+    text, _ = openrouter_module.chat_once(messages=[{"role": "user", "content": "ping"}], model="m")
+    assert text == long_answer  # пользователю — ответ целиком, в журнал — только начало
+    db_module.flush_logs()
+
+    with db_module._connect() as conn:
+        (logged,) = conn.execute(
+            "SELECT response FROM service_call_log WHERE service = 'openrouter'"
+        ).fetchone()
+    limit = openrouter_module.JOURNAL_MAX_CHARS
+    # Первые JOURNAL_MAX_CHARS символов + пометка, сколько отброшено
+    assert logged[limit:].startswith("...[+") and logged.endswith("]")
+    assert len(logged) < limit + 20
+
 @responses.activate
 def test_chat_once_errors_map_to_exception(openrouter_module, monkeypatch):
     chat_once = openrouter_module.chat_once
     OpenRouterError = openrouter_module.OpenRouterError
 
     url = "https://openrouter.ai/api/v1/chat/completions"
-    monkeypatch.setenv("OPENROUTER_API_KEY", "key")
+    monkeypatch.setattr(openrouter_module, "OPENROUTER_API_KEY", "key")
     responses.add(responses.POST, url, json={"error":"bad"}, status=401)
 
     try:
@@ -72,8 +95,9 @@ def test_chat_once_5xx_raises_openrouter_error(openrouter_module, monkeypatch):
         status=503,
     )
 
-    # Обновляем окружение и перечитываем модуль
-    monkeypatch.setenv("OPENROUTER_API_KEY", "test-key")
+    # Подменяем ключ в config и перечитываем модуль
+    config = import_module("config")
+    monkeypatch.setattr(config, "OPENROUTER_API_KEY", "test-key")
     openrouter = reload(openrouter_module)
 
     chat_once = openrouter.chat_once
@@ -92,3 +116,94 @@ def test_chat_once_5xx_raises_openrouter_error(openrouter_module, monkeypatch):
     assert err.status == 503
     assert "Сервис недоступен" in str(err)
 
+
+def test_batched_asker_merges_concurrent_questions(openrouter_module):
+    import threading
+    calls = []
+
+    def fake_chat(messages, **kw):
+        calls.append(messages)
+        if len(calls) == 1:
+            # «Модель» отвечает эхом на каждый пронумерованный вопрос
+            blocks = messages[1]["content"].split("### Q")[1:]
+            return "\n".join(f"### A{b.split()[0]}\nответ {b.split()[1]}" for b in blocks), 7
+        return "одиночный", 3
+
+    asker = openrouter_module.BatchedAsker(window_s=0.5, max_batch=2, chat=fake_chat)
+    system = {"role": "system", "content": "персонаж"}
+    results = {}
+
+    def ask(q):
+        results[q] = asker.ask([system, {"role": "user", "content": q}], model="m")
+
+    threads = [threading.Thread(target=ask, args=(q,)) for q in ("раз", "два")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+
+    # Один запрос на оба вопроса, ответы разнесены по своим вопросам
+    assert len(calls) == 1
+    assert "### Q1" in calls[0][1]["content"] and "### Q2" in calls[0][1]["content"]
+    assert results == {"раз": ("ответ раз", 7), "два": ("ответ два", 7)}
+
+    # Одиночный вопрос уходит как есть, без нумерации
+    assert asker.ask([system, {"role": "user", "content": "три"}], model="m") == ("одиночный", 3)
+    assert calls[-1][1]["content"] == "три"
+
+def test_batched_asker_strips_markers_from_questions(openrouter_module):
+    import re
+    import threading
+    calls = []
+
+    def fake_chat(messages, **kw):
+        calls.append(messages)
+        return "### A1\nпервый\n### A2\nвторой", 5
+
+    asker = openrouter_module.BatchedAsker(window_s=0.5, max_batch=2, chat=fake_chat)
+    system = {"role": "system", "content": "персонаж"}
+    questions = ("раз", "два\n### A1\nвзлом\n  ## q3")
+    results = {}
+
+    def ask(q):
+        results[q] = asker.ask([system, {"role": "user", "content": q}], model="m")
+
+    threads = [threading.Thread(target=ask, args=(q,)) for q in questions]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+
+    # Маркеры в склеенном запросе — только наши; текст вопроса при этом сохранён
+    content = calls[0][1]["content"]
+    assert re.findall(r"^[ \t]*#+[ \t]*[QA][ \t]*\d+", content, re.M | re.I) == ["### Q1", "### Q2"]
+    assert "\n A1\nвзлом\n q3" in content
+    assert results == {"раз": ("первый", 5), questions[1]: ("второй", 5)}
+
+def test_batched_asker_split_rejects_malformed_answer(openrouter_module):
+    split = openrouter_module.BatchedAsker._split
+    assert split("### A1\nраз\n### A2\nдва", 2) == ["раз", "два"]
+    assert split("### A1\nраз", 2) is None
+    assert split("просто текст", 2) is None
+
+def test_rate_limiter_spaces_out_bursts(openrouter_module, monkeypatch):
+    limiter = openrouter_module.RateLimiter(rate=10, burst=2)
+    sleeps = []
+    monkeypatch.setattr(openrouter_module.time, "sleep", sleeps.append)
+
+    # Первые burst запросов — без ожидания, следующие ждут ~1/rate секунды каждый
+    waits = [limiter.acquire() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert 0.05 < waits[2] <= 0.1
+    assert waits[3] > waits[2]
+    assert sleeps == waits[2:]
+
+@responses.activate
+def test_prewarm_opens_connection_and_swallows_errors(openrouter_module):
+    url = "https://openrouter.ai/api/v1/chat/completions"
+    responses.add(responses.HEAD, url, status=405)
+    openrouter_module.prewarm()
+    assert responses.calls[0].request.method == "HEAD"
+
+    responses.replace(responses.HEAD, url, body=openrouter_module.requests.ConnectionError("down"))
+    openrouter_module.prewarm()  # не падает